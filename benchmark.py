@@ -0,0 +1,234 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from pathlib import Path
+from random import Random
+
+MIRROR_SCRIPT = Path(__file__).with_name("mirror.py")
+# The sizes each shape has at '--scale 1', most runs want a fraction of that.
+SHAPES = {
+    "tiny": "1,000,000 files of up to 4 KiB, 1,000 per folder",
+    "wide": "100,000 files of 100 bytes in a single folder",
+    "deep": "10,000 nested folders with one small file in each, in chains as deep as mirror names allow (about 80 folders)",
+    "huge": "3 sparse files of 10 GiB",
+}
+STRATEGIES = ["copy", "hardlink", "reflink", "auto"]
+PATH_SEPARATOR = "#,"
+# The longest file name most filesystems take. The mirror is flat, so a file's mirror name holds every folder above it.
+NAME_MAX = 255
+
+
+def scaled(count: int, scale: float) -> int:
+    return max(1, round(count * scale))
+
+def write_file(path: Path, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def generate_tiny(root: Path, scale: float, rng: Random) -> tuple[int, int]:
+    files = scaled(1_000_000, scale)
+    total = 0
+    for i in range(files):
+        folder = root / f"group{i // 100_000}" / f"folder{i // 1000}"
+        if i % 1000 == 0:
+            folder.mkdir(parents=True)
+        data = rng.randbytes(rng.randint(0, 4096))
+        write_file(folder / f"file{i}.bin", data)
+        total += len(data)
+    return files, total
+
+def generate_wide(root: Path, scale: float, rng: Random) -> tuple[int, int]:
+    files = scaled(100_000, scale)
+    folder = root / "wide"
+    folder.mkdir()
+    for i in range(files):
+        write_file(folder / f"file{i}.txt", rng.randbytes(100))
+    return files, files * 100
+
+def generate_deep(root: Path, scale: float, rng: Random) -> tuple[int, int]:
+    folders = scaled(10_000, scale)
+    # Deeper chains would give mirror names longer than NAME_MAX, and every file in them would fail to copy.
+    chain_depth = (NAME_MAX - len(f"{folders}{PATH_SEPARATOR}file.txt")) // len(f"d{PATH_SEPARATOR}")
+    for chain, first in enumerate(range(0, folders, chain_depth)):
+        folder = root / str(chain)
+        folder.mkdir()
+        for _ in range(min(chain_depth, folders - first)):
+            folder /= "d"
+            folder.mkdir()
+            write_file(folder / "file.txt", rng.randbytes(64))
+    return folders, folders * 64
+
+def generate_huge(root: Path, scale: float, rng: Random) -> tuple[int, int]:
+    size = scaled(10 * 1024 ** 3, scale)
+    for i in range(3):
+        with open(root / f"huge{i}.bin", "wb") as f:
+            f.truncate(size)
+            # A little real data at both ends so the files aren't entirely holes.
+            f.write(rng.randbytes(min(size, 1024 * 1024)))
+            f.seek(max(0, size - 1024 * 1024))
+            f.write(rng.randbytes(min(size, 1024 * 1024)))
+    return 3, 3 * size
+
+GENERATORS = {
+    "tiny": generate_tiny,
+    "wide": generate_wide,
+    "deep": generate_deep,
+    "huge": generate_huge,
+}
+
+def write_config(folder: Path, root: Path, strategy: str):
+    config = "\n".join((
+        f"ROOT_FOLDER_PATH = {json.dumps(str(root))}",
+        "EXCLUSION_OVERRIDES = []",
+        "CLOSE_DELAY = 0",
+        "PRESERVE_FILE_NAMES = true",
+        f"MIRROR_FOLDER_PATH = {json.dumps(str(folder))}",
+        f"PATH_SEPARATOR = {json.dumps(PATH_SEPARATOR)}",
+        "INCREMENTAL = true",
+        f"COPY_STRATEGY = \"{strategy}\"",
+    ))
+    (folder / "mirror_config.toml").write_text(config)
+
+def run_mirror(folder: Path, workers: int, extra_args: list[str], timeout: float) -> dict:
+    stats_path = folder / "stats.json"
+    stats_path.unlink(missing_ok=True)
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(
+            [sys.executable, str(MIRROR_SCRIPT), "-j", str(workers), "--stats", str(stats_path), *extra_args],
+            cwd=folder, capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return {"wall_seconds": time.perf_counter() - start, "returncode": None, "error": f"timed out after {timeout}s"}
+    result = {
+        "wall_seconds": time.perf_counter() - start,
+        "returncode": process.returncode,
+        # Files that failed to copy are logged, they don't make mirror.py exit with an error.
+        "logged_errors": process.stdout.count("ERROR: "),
+    }
+    if stats_path.exists():
+        result["stats"] = json.loads(stats_path.read_text())
+    if process.returncode != 0:
+        result["error"] = process.stderr.strip().splitlines()[-1:] or ["no output"]
+    elif result["logged_errors"] > 0:
+        result["error"] = f"{result['logged_errors']} error(s) logged"
+    return result
+
+def time_process(command: list[str], folder: Path) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, cwd=folder, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+def parse_importtime(output: str) -> dict:
+    # Lines look like 'import time:  self [us] | cumulative | imported package', nested imports are indented.
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line.removeprefix("import time:").split("|")
+        modules.append((name, int(own), int(cumulative)))
+    top_level = sorted(((name.strip(), cumulative) for name, _own, cumulative in modules if not name.startswith("  ")), key=lambda module: -module[1])
+    return {
+        "modules": len(modules),
+        "import_seconds": sum(own for _name, own, _cumulative in modules) / 1_000_000,
+        "slowest_imports": {name: cumulative / 1_000_000 for name, cumulative in top_level[:10]},
+    }
+
+def benchmark_startup(runs: int, workspace: Path) -> dict:
+    """Time fresh mirror.py processes over a root folder with a single file, where starting up is most of the work."""
+    root = workspace / "root-startup"
+    root.mkdir()
+    write_file(root / "file.txt", b"startup")
+    folder = workspace / "run-startup"
+    folder.mkdir()
+    write_config(folder, root, "copy")
+    command = [sys.executable, str(MIRROR_SCRIPT)]
+    # The first run parses mirror_config.toml and copies the file, the rest reuse the cached config and find nothing to do.
+    first_seconds = time_process(command, folder)
+    seconds = [time_process(command, folder) for _ in range(runs)]
+    interpreter_seconds = [time_process([sys.executable, "-c", "pass"], folder) for _ in range(runs)]
+    # The interpreter's own imports (site and whatever it pulls in) are reported too, the baseline tells them apart.
+    process = subprocess.run([sys.executable, "-X", "importtime", str(MIRROR_SCRIPT)], cwd=folder, capture_output=True, text=True, check=True)
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], cwd=folder, capture_output=True, text=True, check=True)
+    imports = parse_importtime(process.stderr)
+    baseline_imports = parse_importtime(baseline.stderr)
+    shutil.rmtree(folder)
+    shutil.rmtree(root)
+    return {
+        "runs": runs,
+        "first_run_seconds": first_seconds,
+        "median_seconds": statistics.median(seconds),
+        "min_seconds": min(seconds),
+        "interpreter_median_seconds": statistics.median(interpreter_seconds),
+        **imports,
+        "baseline_modules": baseline_imports["modules"],
+        "baseline_import_seconds": baseline_imports["import_seconds"],
+    }
+
+def benchmark(shapes: list[str], strategies: list[str], worker_counts: list[int], scale: float, seed: int, timeout: float, startup_runs: int, workspace: Path) -> dict:
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "scale": scale,
+        "seed": seed,
+        "shapes": {},
+        "results": [],
+    }
+    if startup_runs > 0:
+        startup = report["startup"] = benchmark_startup(startup_runs, workspace)
+        print(f"Startup: {startup['median_seconds']:.3f}s ({startup['interpreter_median_seconds']:.3f}s of it the interpreter), "
+              f"{startup['modules']} module(s) imported in {startup['import_seconds']:.3f}s", file=sys.stderr)
+    for shape in shapes:
+        root = workspace / f"root-{shape}"
+        root.mkdir()
+        start = time.perf_counter()
+        files, size = GENERATORS[shape](root, scale, Random(seed))
+        report["shapes"][shape] = {"files": files, "bytes": size, "generate_seconds": time.perf_counter() - start}
+        print(f"Generated '{shape}': {files} file(s), {size / 1024 ** 2:.1f} MiB", file=sys.stderr)
+
+        for strategy in strategies:
+            for workers in worker_counts:
+                folder = workspace / f"run-{shape}-{strategy}-{workers}"
+                folder.mkdir()
+                write_config(folder, root, strategy)
+                # Initial copy into an empty mirror, an incremental run with nothing changed, then a full erase and recopy.
+                for run, extra_args in (("initial", []), ("unchanged", []), ("full", ["--full"])):
+                    result = run_mirror(folder, workers, extra_args, timeout)
+                    report["results"].append({"shape": shape, "strategy": strategy, "workers": workers, "run": run, **result})
+                    print(f"{shape:>6} {strategy:>8} {workers:>3} worker(s) {run:>9}: {result['wall_seconds']:.3f}s"
+                          + (f" FAILED ({result['error']})" if "error" in result else ""), file=sys.stderr)
+                shutil.rmtree(folder)
+        shutil.rmtree(root)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time mirror.py on generated folder trees. Shapes: " + "; ".join(f"{name}: {shape}" for name, shape in SHAPES.items()))
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="comma separated shapes to generate (default: all)")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="comma separated COPY_STRATEGY values to try (default: all)")
+    parser.add_argument("--workers", default="1,4,16", help="comma separated worker counts to try (default: 1,4,16)")
+    parser.add_argument("--scale", type=float, default=0.01, help="fraction of the full shape sizes to generate (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated file contents")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds before a single mirror.py run is given up on")
+    parser.add_argument("--startup-runs", type=int, default=20, help="how many times to time mirror.py starting up on a single file, 0 to skip (default: 20)")
+    parser.add_argument("--workspace", help="folder to generate the trees in (default: a new temporary folder)")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    shapes = args.shapes.split(",")
+    strategies = args.strategies.split(",")
+    unknown = [shape for shape in shapes if shape not in SHAPES] + [strategy for strategy in strategies if strategy not in STRATEGIES]
+    if unknown:
+        parser.error(f"unknown shape or strategy: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory(prefix="mirror-bench-", dir=args.workspace) as workspace:
+        report = benchmark(shapes, strategies, [int(workers) for workers in args.workers.split(",")], args.scale, args.seed, args.timeout, args.startup_runs, Path(workspace))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to '{args.output}'", file=sys.stderr)
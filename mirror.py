@@ -1,14 +1,32 @@
-import shutil
-import argparse
-import tomllib
+# Modules only some runs need (reading a changed config, hashing, --watch, staying open, --stats) are imported
+# where they're used, most runs are over in a moment and shouldn't spend it importing.
+import os
+import errno
 import time
 import logging
+import math
+import struct
+import marshal
+import signal
+import stat
+import re
+import atexit
+import threading
 import sys
 
 from pathlib import Path
 from typing import ClassVar
-from string import ascii_letters
-from random import choices
+from array import array
+from contextlib import contextmanager
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STARTED = time.perf_counter()
 
 
 class CustomFormatter(logging.Formatter):
@@ -27,108 +45,2221 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset,
     }
 
+    def __init__(self):
+        super().__init__()
+        # Made once, a Formatter per record adds up over millions of files.
+        self.formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+        self.default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
-
-if not Path("mirror_config.toml").exists():
-    default_config: tuple[str] = (
-        "# The path to the folder that includes all of your subfolders.",
-        "ROOT_FOLDER_PATH = \"\"\n",
-        "# By default folders starting with '.' in the root folder are excluded, create exclusing by passing in folder names here.",
-        "EXCLUSION_OVERRIDES = [\".Single\"]\n",
-        "# How long the program stays open (IN SECONDS) before it closes the terminal, set to -1 to never close unless closed by you.",
-        "CLOSE_DELAY = 0\n",
-        "# Wether to include the original file names in the mirror folder, does not work when using '--randomize'",
-        "PRESERVE_FILE_NAMES = true\n",
-        "# Where should the .Mirror folder be placed and read from? Set to '.' for root folder.",
-        "MIRROR_FOLDER_PATH = \".\"\n",
-        "# Folder separator for mirrored files, so if a file was located at '<root>/a/b/file.txt' it would be 'a<PATH SEPARATOR>b<PATH SEPARATOR>file.txt' in the mirror folder.",
-        "PATH_SEPARATOR = \"#,\""
-    )
-    with open("mirror_config.toml", "wb") as f:
-        f.write("\n".join(default_config).encode("utf-8"))
-
-with open("mirror_config.toml") as f:
-    config = tomllib.loads(f.read())
-
-parser = argparse.ArgumentParser()
-parser.add_argument("-v", "--verbose", action="store_true")
-
-args = parser.parse_args()
-
-ROOT_FOLDER_PATH: Path = Path(config.get("ROOT_FOLDER_PATH"))
-EXCLUSION_OVERRIDES: list[str] = config.get("EXCLUSION_OVERRIDES")
-CLOSE_DELAY: int = config.get("CLOSE_DELAY")
-PRESERVE_FILE_NAMES: bool = config.get("PRESERVE_FILE_NAMES")
-MIRROR_FOLDER_PATH: Path = ROOT_FOLDER_PATH if config.get("MIRROR_FOLDER_PATH") == "." else Path(config.get("MIRROR_FOLDER_PATH"))
-PATH_SEPARATOR: str = config.get("PATH_SEPARATOR")
+        return self.formatters.get(record.levelno, self.default_formatter).format(record)
+
+def read_config(create_default: bool = True) -> dict:
+    """The settings in mirror_config.toml. A missing file is written with the defaults first, or with 'create_default' off raises FileNotFoundError."""
+    if not Path("mirror_config.toml").exists():
+        if not create_default:
+            raise FileNotFoundError(errno.ENOENT, "No mirror configuration here, pass one as 'config' or create it", os.path.abspath("mirror_config.toml"))
+        default_config: tuple[str] = (
+            "# The path to the folder that includes all of your subfolders.",
+            "ROOT_FOLDER_PATH = \"\"\n",
+            "# By default folders starting with '.' in the root folder are excluded, create exclusing by passing in folder names here.",
+            "EXCLUSION_OVERRIDES = [\".Single\"]\n",
+            "# What to leave out of the mirror, like a .gitignore: '*.tmp' matches names in any folder, '/build' and 'a/b/*.log' match paths from the root folder, a trailing '/' only matches folders,",
+            "# '**' matches any number of folders and '*.{jpg,png}' either extension. 'size>100M' and 'age>30d' (s, m, h, d or w) leave out files by size or by how long ago they changed.",
+            "# Excluded folders are never looked into.",
+            "EXCLUDE = [\".*\", \"*.ini\"]\n",
+            "# What to mirror even if it matches EXCLUDE, written the same way. EXCLUSION_OVERRIDES are included too.",
+            "INCLUDE = []\n",
+            "# How long the program stays open (IN SECONDS) before it closes the terminal, set to -1 to never close unless closed by you (see RESYNC_INTERVAL).",
+            "CLOSE_DELAY = 0\n",
+            "# Wether to include the original file names in the mirror folder, does not work when using '--randomize'",
+            "PRESERVE_FILE_NAMES = true\n",
+            "# Where should the .Mirror folder be placed and read from? Set to '.' for root folder.",
+            "MIRROR_FOLDER_PATH = \".\"\n",
+            "# Folder separator for mirrored files, so if a file was located at '<root>/a/b/file.txt' it would be 'a<PATH SEPARATOR>b<PATH SEPARATOR>file.txt' in the mirror folder.",
+            "PATH_SEPARATOR = \"#,\"\n",
+            "# Only copy new or changed files (compared by size and modification time) and delete mirrored files whose source is gone, instead of erasing and recopying the whole mirror.",
+            "INCREMENTAL = true\n",
+            "# When a file's size matches but its modification time doesn't, compare file hashes before recopying it. Only used with INCREMENTAL.",
+            "COMPARE_HASHES = false\n",
+            "# How many files are copied at the same time, set to 0 to pick a number based on the CPUs available to this program.",
+            "WORKERS = 0\n",
+            "# How files get into the mirror: 'copy' copies the bytes, 'hardlink' and 'reflink' share the data with the original file (both need the mirror on the same drive, reflink also needs btrfs or XFS) and 'auto' picks the best one that works.",
+            "# Careful: with 'hardlink' (which 'auto' picks when it can) the mirrored file IS the original file, editing one edits the other.",
+            "COPY_STRATEGY = \"copy\"\n",
+            "# Build the updated mirror next to the current one and swap it in when it's done, so the mirror is never seen half updated. Unchanged files are hardlinked over, the previous mirror is deleted in the background.",
+            "STAGED_BUILD = false\n",
+            "# What to do with symlinks in the root folder: 'follow' mirrors what they point at (a folder only once, even if several links lead to it), 'skip' leaves them out and 'link' mirrors them as links.",
+            "SYMLINKS = \"follow\"\n",
+            "# Store files with the same contents only once: the first one is copied, the others become hardlinks to it inside the mirror. Every file gets hashed (once, the hashes are remembered).",
+            "# Not used when files are mirrored as hardlinks to the originals, they already take no space.",
+            "DEDUPLICATE = false\n",
+            "# Hash files while they're copied and remember the hashes, so '--verify' can check the mirror later without reading the originals again.",
+            "HASH_COPIES = false\n",
+            "# How files are hashed (for HASH_COPIES, DEDUPLICATE and COMPARE_HASHES): 'blake2b', 'sha256' or 'crc32'. crc32 is much faster but only good for spotting damaged files, it can't be used with DEDUPLICATE.",
+            "HASH_ALGORITHM = \"blake2b\"\n",
+            "# Hash big files in this many separate processes instead of in the copying threads, so hashing can use every CPU. Set to 0 to not start any.",
+            "HASH_WORKERS = 0\n",
+            "# How many megabytes are handed to the operating system per copy call when copying file contents, bigger is faster for huge files.",
+            "COPY_CHUNK_SIZE_MB = 64\n",
+            "# How many files can be waiting to be copied before finding more files pauses, set to 0 to use 64 per worker. Keeps memory use flat on huge folders.",
+            "COPY_QUEUE_SIZE = 0\n",
+            "# Files are copied in three lanes by size, each with workers of its own, so a few huge files can't hold up all the small ones.",
+            "# The sizes (IN MEGABYTES) at which the medium and the huge lane start.",
+            "LANE_SIZES_MB = [1, 256]\n",
+            "# How many medium and huge files are copied at the same time, the small ones get WORKERS. Set to 0 to pick a number based on WORKERS.",
+            "LANE_WORKERS = [0, 0]\n",
+            "# With '--watch', how long (IN MILLISECONDS) it has to be quiet before a burst of changes is copied to the mirror.",
+            "WATCH_DEBOUNCE_MS = 200\n",
+            "# When staying open (CLOSE_DELAY = -1 or '--watch'), update the whole mirror again every this many seconds, set to 0 to never do so.",
+            "RESYNC_INTERVAL = 0\n",
+            "# Up to this many random seconds are added to every RESYNC_INTERVAL, so many mirrors on one machine don't all run at once.",
+            "RESYNC_JITTER = 0\n",
+            "# While updating, log how many files are done and how fast every this many seconds, set to 0 to not. In a terminal a status line at the bottom shows it instead, kept up to date.",
+            "PROGRESS_INTERVAL = 5\n",
+            "# Before updating, guess how many files there are from about this many walks down the root folder (a few folders each), so the progress shows the time left.",
+            "# 100 is enough for most folders. Set to 0 to not guess, the files the previous run found are used then.",
+            "ESTIMATE_SAMPLES = 0"
+        )
+        with open("mirror_config.toml", "wb") as f:
+            f.write("\n".join(default_config).encode("utf-8"))
+
+    global config_cache_key
+    config_stat = os.stat("mirror_config.toml")
+    key = (CONFIG_CACHE_VERSION, config_stat.st_mtime_ns, config_stat.st_size)
+    try:
+        with open(CONFIG_CACHE_NAME, "rb") as f:
+            cached_key, config = marshal.load(f)
+        if cached_key == key:
+            config_cache_key = None
+            return config
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import tomllib
+    with open("mirror_config.toml") as f:
+        config = tomllib.loads(f.read())
+    config_cache_key = key
+    return config
+
+def cache_config(config: dict):
+    """Remember a config that was just read from mirror_config.toml and applied without errors, so the next run can skip parsing it."""
+    global config_cache_key
+    if config_cache_key is None:
+        return
+    try:
+        # Dates and times are valid TOML but can't be marshalled, such a config is parsed every time.
+        data = marshal.dumps((config_cache_key, config))
+        with open(CONFIG_CACHE_NAME + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(CONFIG_CACHE_NAME + ".tmp", CONFIG_CACHE_NAME)
+    except (OSError, ValueError) as e:
+        logger.debug(f"Could not cache the configuration: {e}")
+    config_cache_key = None
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="log more details, twice to also log what happens to every file and folder")
+    parser.add_argument("--full", action="store_true", help="erase and recopy the whole mirror even when INCREMENTAL is enabled")
+    parser.add_argument("-j", "--workers", type=int, help="number of files copied at the same time, overrides WORKERS")
+    parser.add_argument("--watch", action="store_true", help="keep running after the mirror is updated and mirror changes as they happen (Linux only)")
+    parser.add_argument("--verify", action="store_true", help="check every mirrored file against the hash taken when it was copied (see HASH_COPIES) instead of updating the mirror")
+    parser.add_argument("--stats", nargs="?", const="-", metavar="PATH", help="when exiting, write timings, counts and resource usage as JSON to PATH (or the terminal)")
+    return parser.parse_args()
+
+# Set by main(), None when this file is imported (by the hashing processes, or to use Mirror).
+args = None
 
 REQUIRED_SETTINGS = ["ROOT_FOLDER_PATH", "EXCLUSION_OVERRIDES", "CLOSE_DELAY", "PRESERVE_FILE_NAMES", "MIRROR_FOLDER_PATH", "PATH_SEPARATOR"]
-REAL_MIRROR_FOLDER = MIRROR_FOLDER_PATH / ".Mirror"
+COPY_STRATEGIES = ["reflink", "hardlink", "copy"]
+SYMLINK_POLICIES = ["follow", "skip", "link"]
+# Errors meaning a strategy can't be used for a file, rather than the file itself being a problem.
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK, errno.ENOSYS}
+FICLONE = 0x40049409
+# The read/write fallback holds its chunk in memory once per worker, so it gets a smaller one.
+READ_CHUNK_SIZE = 1024 * 1024
+WATCH = False
+# A burst of changes that never goes quiet still gets mirrored at least this often.
+WATCH_MAX_BATCH_SECONDS = 2
+# Stop on these while staying open, SIGHUP reloads the config instead. Windows only has the first two.
+STOP_SIGNALS = [signal.SIGTERM, signal.SIGINT]
+# Filesystems store modification times with varying precision, a folder changed this recently could change
+# again without its mtime moving. Such folders are always listed on the next run.
+RACY_MTIME_NS = 2_000_000_000
+# Lives inside .Mirror, so it's never mistaken for a mirrored file.
+MANIFEST_NAME = ".mirror-manifest"
+# Next to .Mirror: the mirror being built by STAGED_BUILD, and previous mirrors waiting to be deleted.
+STAGING_FOLDER_NAME = ".Mirror.staging"
+OLD_MIRROR_PREFIX = ".Mirror.old-"
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
 CLOSE_MESSAGE = "This window will close in {0} seconds."
-VERBOSE = args.verbose
+# How often the status line in a terminal is updated, and how far back its speed looks.
+LIVE_PROGRESS_INTERVAL = 0.5
+PROGRESS_WINDOW_SECONDS = 10
+VERBOSE = False
+# mirror_config.toml as it was last read and applied without errors, marshalled. Reused as long as the toml's
+# modification time and size stay the same.
+CONFIG_CACHE_NAME = ".mirror_config.cache"
+CONFIG_CACHE_VERSION = 1
+# Set while a config read from the toml hasn't been cached yet.
+config_cache_key: tuple | None = None
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO if not VERBOSE else logging.DEBUG)
+logger.setLevel(logging.INFO)
+# What happens to every single file and folder, only logged with '-vv'.
+file_logger = logger.getChild("files")
+file_logger.setLevel(logging.INFO)
+
+class StatusHandler(logging.StreamHandler):
+    """StreamHandler that keeps a status line below the log lines, rewritten in place. Only for terminals."""
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.status = ""
+
+    def emit(self, record):
+        # Callers hold self.lock.
+        if self.status:
+            self.stream.write("\r\x1b[K")
+        super().emit(record)
+        if self.status:
+            self.stream.write(self.status)
+            self.flush()
+
+    def set_status(self, status: str):
+        with self.lock:
+            self.stream.write("\r\x1b[K" + status)
+            self.status = status
+            self.flush()
 
-ch = logging.StreamHandler(sys.stdout)
+ch = StatusHandler(sys.stdout)
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
-missing_setting_errors = [
-    f"{setting} not defined in configuration file or has useless value. Find configuration in the same directory as this script"
-    for setting in REQUIRED_SETTINGS if config.get(setting) == "" or config.get(setting) is None
+def log_in_background():
+    """Format and write log records on a thread of their own, so copying never waits for the terminal."""
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, ch)
+    logger.removeHandler(ch)
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    # Runs after non-daemon threads (background deletions) are done, so their records get written too.
+    atexit.register(listener.stop)
+
+# Files the copy workers are done with (whatever happened to them), their bytes and the bytes copied, for the progress lines.
+progress: Counter[str] = Counter()
+# Wall and CPU seconds spent in each phase (config, manifest, erase, walk, copy, cleanup), summed over every update.
+phase_times: dict[str, dict[str, float]] = {}
+# Files, folders and bytes by what happened to them, plus the stat/open/unlink calls made for them.
+counts: Counter[str] = Counter()
+counts_lock = threading.Lock()
+
+@contextmanager
+def timed_phase(name: str):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        times = phase_times.setdefault(name, {"wall_seconds": 0, "cpu_seconds": 0})
+        times["wall_seconds"] += time.perf_counter() - start
+        times["cpu_seconds"] += time.process_time() - cpu_start
+
+def count(name: str, amount: int = 1):
+    # Copy workers count too, and Counter updates aren't atomic.
+    with counts_lock:
+        counts[name] += amount
+
+def read_proc_io() -> dict[str, int]:
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f.read().splitlines())}
+    except OSError:
+        return {}
+
+IO_AT_START = read_proc_io()
+
+def peak_rss_bytes() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux reports KiB, macOS bytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def write_stats():
+    import json
+    report = {
+        "wall_seconds": time.perf_counter() - STARTED,
+        "cpu_seconds": time.process_time(),
+        "phases": phase_times,
+        "counts": dict(sorted(counts.items())),
+        "peak_rss_bytes": peak_rss_bytes(),
+        # Read/write bytes as seen by the kernel ('read_bytes'/'write_bytes' actually hit the disk).
+        "io": {key: value - IO_AT_START.get(key, 0) for key, value in read_proc_io().items()},
+    }
+    if args.stats == "-":
+        print(json.dumps(report, indent=4))
+        return
+    with open(args.stats, "w") as f:
+        json.dump(report, f, indent=4)
+
+def available_cpus() -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        # cgroup v2 quota, e.g. "200000 100000" for two CPUs or "max 100000" for no limit.
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+def glob_to_regex(glob: str) -> str:
+    parts = []
+    i = 0
+    while i < len(glob):
+        char = glob[i]
+        end = -1
+        if glob.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if char == "[":
+            # A ']' right after the '[' is part of the set.
+            end = glob.find("]", i + 2)
+            if end != -1:
+                body = glob[i + 1:end].replace("\\", "\\\\")
+                parts.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+        elif char == "{":
+            end = glob.find("}", i)
+            if end != -1:
+                parts.append("(?:" + "|".join(glob_to_regex(option) for option in glob[i + 1:end].split(",")) + ")")
+        if end != -1:
+            i = end + 1
+            continue
+        parts.append("[^/]*" if char == "*" else "[^/]" if char == "?" else re.escape(char))
+        i += 1
+    return "".join(parts)
+
+class Rules:
+    """A list of EXCLUDE or INCLUDE patterns, compiled into one regular expression per kind of pattern.
+
+    Checking an entry costs the same however many patterns there are. Only size/age
+    predicates need the entry's stat, and only for files.
+    """
+
+    PREDICATE: ClassVar[re.Pattern] = re.compile(r"(size|age)\s*([<>])\s*(\d+(?:\.\d+)?)\s*([a-z]*)", re.IGNORECASE)
+    UNITS: ClassVar[dict[str, dict[str, int]]] = {
+        "size": {"": 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024 ** 2, "mb": 1024 ** 2, "g": 1024 ** 3, "gb": 1024 ** 3, "t": 1024 ** 4, "tb": 1024 ** 4},
+        "age": {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800},
+    }
+    NOTHING: ClassVar[re.Pattern] = re.compile(r"(?!)")
+
+    def __init__(self, patterns: list[str]):
+        # Names are matched in any folder, paths from the root folder. Patterns ending in '/' only match folders.
+        names = {"file": [], "folder": []}
+        paths = {"file": [], "folder": []}
+        self.predicates = []
+        for pattern in patterns:
+            predicate = self.PREDICATE.fullmatch(pattern.strip())
+            if predicate:
+                kind, operator, amount, unit = predicate.groups()
+                if unit.lower() not in self.UNITS[kind]:
+                    raise ValueError(f"unknown unit '{unit}' in '{pattern}'")
+                self.predicates.append((kind, operator, float(amount) * self.UNITS[kind][unit.lower()]))
+                continue
+            applies_to = "folder" if pattern.endswith("/") else "file"
+            glob = pattern.rstrip("/")
+            if not glob:
+                continue
+            # Like .gitignore, a '/' anywhere but the end ties the pattern to the root folder.
+            (paths if "/" in glob else names)[applies_to].append(glob_to_regex(glob.lstrip("/")))
+            if glob.endswith("/**") and glob.strip("/*"):
+                # Everything below a folder is the folder itself as far as walking goes, it isn't even listed.
+                paths["folder"].append(glob_to_regex(glob[:-3].lstrip("/")))
+        self.file_names = self.compile(names["file"])
+        self.folder_names = self.compile(names["file"] + names["folder"])
+        self.file_paths = self.compile(paths["file"])
+        self.folder_paths = self.compile(paths["file"] + paths["folder"])
+
+    def compile(self, regexes: list[str]) -> re.Pattern:
+        return re.compile("(?:" + "|".join(regexes) + r")\Z", re.DOTALL) if regexes else self.NOTHING
+
+    def matches(self, relative: str, name: str, is_folder: bool, entry: os.DirEntry) -> bool:
+        """Whether the entry at 'relative' (relative to the root folder) matches any of the patterns."""
+        if os.sep != "/":
+            relative = relative.replace(os.sep, "/")
+        if is_folder:
+            return bool(self.folder_names.match(name) or self.folder_paths.match(relative))
+        if self.file_names.match(name) or self.file_paths.match(relative):
+            return True
+        if not self.predicates:
+            return False
+        count("stat")
+        entry_stat = entry.stat(follow_symlinks=SYMLINKS != "link")
+        for kind, operator, limit in self.predicates:
+            value = entry_stat.st_size if kind == "size" else time.time() - entry_stat.st_mtime
+            if (value > limit) if operator == ">" else (value < limit):
+                return True
+        return False
+
+def is_excluded(relative: str, name: str, is_folder: bool, entry: os.DirEntry) -> bool:
+    if not exclude_rules.matches(relative, name, is_folder, entry):
+        return False
+    return name not in EXCLUSION_OVERRIDES and not include_rules.matches(relative, name, is_folder, entry)
+
+def apply_config(config: dict) -> bool:
+    """Switch the settings over to 'config', or log what's wrong with it and keep the current ones."""
+    global ROOT_FOLDER_PATH, EXCLUSION_OVERRIDES, CLOSE_DELAY, PRESERVE_FILE_NAMES, MIRROR_FOLDER_PATH, PATH_SEPARATOR, \
+        INCREMENTAL, COMPARE_HASHES, WORKERS, COPY_STRATEGY, COPY_CHUNK_SIZE, WATCH_DEBOUNCE_MS, RESYNC_INTERVAL, RESYNC_JITTER, PROGRESS_INTERVAL, ESTIMATE_SAMPLES, \
+        STAGED_BUILD, COPY_QUEUE_SIZE, LANE_SIZES, LANE_WORKERS, SYMLINKS, DEDUPLICATE, HASH_COPIES, HASH_ALGORITHM, HASH_WORKERS, EXCLUDE, INCLUDE, exclude_rules, include_rules, REAL_MIRROR_FOLDER
+    missing_setting_errors = [
+        f"{setting} not defined in configuration file or has useless value. Find configuration in the same directory as this script"
+        for setting in REQUIRED_SETTINGS if config.get(setting) == "" or config.get(setting) is None
+    ]
+    if missing_setting_errors:
+        logger.critical("\n".join(missing_setting_errors) + "\n")
+        logger.critical("Don't see some of those setting in your config file? Delete it and allow it to regenerate.")
+        return False
+
+    root = Path(config.get("ROOT_FOLDER_PATH"))
+    strategy = config.get("COPY_STRATEGY", "copy")
+    chunk_size = config.get("COPY_CHUNK_SIZE_MB", 64) * 1024 * 1024
+    if chunk_size <= 0:
+        logger.critical("COPY_CHUNK_SIZE_MB must be bigger than 0.")
+        return False
+    symlinks = config.get("SYMLINKS", "follow")
+    if symlinks not in SYMLINK_POLICIES:
+        logger.critical(f"SYMLINKS must be one of 'follow', 'skip' or 'link', not '{symlinks}'.")
+        return False
+    exclude = config.get("EXCLUDE", [".*", "*.ini"])
+    include = config.get("INCLUDE", [])
+    try:
+        compiled_exclude = Rules(exclude)
+        compiled_include = Rules(include)
+    except (ValueError, re.error) as e:
+        logger.critical(f"Invalid EXCLUDE or INCLUDE pattern: {e}")
+        return False
+    hash_algorithm = config.get("HASH_ALGORITHM", "blake2b")
+    if hash_algorithm not in HASH_ALGORITHMS:
+        logger.critical(f"HASH_ALGORITHM must be one of 'blake2b', 'sha256' or 'crc32', not '{hash_algorithm}'.")
+        return False
+    if config.get("DEDUPLICATE", False) and hash_algorithm in WEAK_HASH_ALGORITHMS:
+        logger.critical(f"DEDUPLICATE can't tell files apart by their '{hash_algorithm}' hash, use 'blake2b' or 'sha256'.")
+        return False
+    if strategy not in COPY_STRATEGIES + ["auto"]:
+        logger.critical(f"COPY_STRATEGY must be one of 'copy', 'hardlink', 'reflink' or 'auto', not '{strategy}'.")
+        return False
+    lane_sizes = [int(size * 1024 * 1024) for size in config.get("LANE_SIZES_MB", [1, 256])]
+    if len(lane_sizes) != 2 or not 0 < lane_sizes[0] <= lane_sizes[1]:
+        logger.critical("LANE_SIZES_MB must be two sizes bigger than 0, the smaller one first.")
+        return False
+    lane_workers = config.get("LANE_WORKERS", [0, 0])
+    if len(lane_workers) != 2 or min(lane_workers) < 0:
+        logger.critical("LANE_WORKERS must be two worker counts, 0 or more.")
+        return False
+    if not root.exists():
+        logger.critical("Root folder path doesn't actually exist, double check your spelling.")
+        return False
+
+    ROOT_FOLDER_PATH = root
+    EXCLUSION_OVERRIDES = config.get("EXCLUSION_OVERRIDES")
+    CLOSE_DELAY = config.get("CLOSE_DELAY")
+    PRESERVE_FILE_NAMES = config.get("PRESERVE_FILE_NAMES")
+    MIRROR_FOLDER_PATH = ROOT_FOLDER_PATH if config.get("MIRROR_FOLDER_PATH") == "." else Path(config.get("MIRROR_FOLDER_PATH"))
+    PATH_SEPARATOR = config.get("PATH_SEPARATOR")
+    INCREMENTAL = config.get("INCREMENTAL", False) and not (args and args.full)
+    COMPARE_HASHES = config.get("COMPARE_HASHES", False)
+    WORKERS = args.workers if args and args.workers is not None else config.get("WORKERS", 0)
+    if WORKERS <= 0:
+        # Copying mostly waits on the disk, so allow a few files in flight per CPU.
+        WORKERS = min(32, available_cpus() * 4)
+    COPY_QUEUE_SIZE = config.get("COPY_QUEUE_SIZE", 0)
+    if COPY_QUEUE_SIZE <= 0:
+        COPY_QUEUE_SIZE = WORKERS * 64
+    LANE_SIZES = lane_sizes
+    # Huge files are limited by the disks rather than by waiting on them, a few at a time is enough.
+    LANE_WORKERS = [WORKERS, lane_workers[0] or max(1, WORKERS // 2), lane_workers[1] or max(1, min(4, WORKERS // 4))]
+    COPY_STRATEGY = strategy
+    COPY_CHUNK_SIZE = chunk_size
+    WATCH_DEBOUNCE_MS = config.get("WATCH_DEBOUNCE_MS", 200)
+    RESYNC_INTERVAL = config.get("RESYNC_INTERVAL", 0)
+    RESYNC_JITTER = config.get("RESYNC_JITTER", 0)
+    PROGRESS_INTERVAL = config.get("PROGRESS_INTERVAL", 5)
+    ESTIMATE_SAMPLES = config.get("ESTIMATE_SAMPLES", 0)
+    STAGED_BUILD = config.get("STAGED_BUILD", False)
+    SYMLINKS = symlinks
+    DEDUPLICATE = config.get("DEDUPLICATE", False)
+    HASH_COPIES = config.get("HASH_COPIES", False)
+    HASH_ALGORITHM = hash_algorithm
+    HASH_WORKERS = config.get("HASH_WORKERS", 0)
+    EXCLUDE = exclude
+    INCLUDE = include
+    exclude_rules = compiled_exclude
+    include_rules = compiled_include
+    REAL_MIRROR_FOLDER = MIRROR_FOLDER_PATH / ".Mirror"
+    return True
+
+class Crc32:
+    """zlib.crc32 with the update()/digest() of a hashlib object."""
+
+    def __init__(self):
+        import zlib
+        self.crc32 = zlib.crc32
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+HASH_ALGORITHMS = ["blake2b", "sha256", "crc32"]
+# Good for spotting damage, but different files are too likely to share a hash to treat them as the same.
+WEAK_HASH_ALGORITHMS = {"crc32"}
+# Smaller files are hashed quicker than they can be handed to another process.
+PROCESS_HASH_MIN_SIZE = 1024 * 1024
+hash_pool: "ProcessPoolExecutor | None" = None
+hash_pool_size = 0
+# Copy threads ask for the pool at the same time, only one of them may start (or replace) it.
+hash_pool_lock = threading.Lock()
+
+def new_hasher(algorithm: str):
+    if algorithm == "crc32":
+        return Crc32()
+    import hashlib
+    return getattr(hashlib, algorithm)()
+
+def hash_file(path: str, algorithm: str) -> bytes:
+    # Also runs in the hashing processes, where the settings were never loaded.
+    import hashlib
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, lambda: new_hasher(algorithm)).digest()
+
+def hashing_pool() -> "ProcessPoolExecutor":
+    global hash_pool, hash_pool_size
+    with hash_pool_lock:
+        if hash_pool is None or hash_pool_size != HASH_WORKERS:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            if hash_pool is not None:
+                hash_pool.shutdown(wait=False)
+            # Forking a process with copy threads running isn't safe, start from a clean one.
+            context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=context)
+            hash_pool_size = HASH_WORKERS
+        return hash_pool
+
+def file_digest(path: str, size: int | None = None) -> bytes:
+    """Hash the file at 'path', in one of the HASH_WORKERS processes if it's big ('size') enough to be worth sending there."""
+    count("open")
+    if HASH_WORKERS > 0 and (size is None or size >= PROCESS_HASH_MIN_SIZE):
+        return hashing_pool().submit(hash_file, path, HASH_ALGORITHM).result()
+    return hash_file(path, HASH_ALGORITHM)
+
+def is_unchanged(source: str, source_stat: os.stat_result, target: str) -> tuple[bool, bytes | None]:
+    """Whether 'target' is already a copy of 'source', and the hash of 'source' if it took one to find out."""
+    count("stat")
+    try:
+        # Not followed, a file that used to be a symlink (SYMLINKS = 'link') is never up to date.
+        target_stat = os.lstat(target)
+    except FileNotFoundError:
+        return False, None
+    if stat.S_ISLNK(target_stat.st_mode) or source_stat.st_size != target_stat.st_size:
+        return False, None
+    if source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+        return True, None
+    if COMPARE_HASHES:
+        digest = file_digest(source, source_stat.st_size)
+        if digest == file_digest(target, target_stat.st_size):
+            # Same contents, only the timestamp moved. Adopt it so the next run doesn't hash again.
+            os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            return True, digest
+    return False, None
+
+def reflink_file(source: str, target: str):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    count("open", 2)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def copy_range_chunk(src_fd: int, dst_fd: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE)
+
+def sendfile_chunk(src_fd: int, dst_fd: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, COPY_CHUNK_SIZE)
+
+def read_write_chunk(src_fd: int, dst_fd: int, hasher=None) -> int:
+    data = memoryview(os.read(src_fd, min(COPY_CHUNK_SIZE, READ_CHUNK_SIZE)))
+    if hasher is not None:
+        hasher.update(data)
+    written = 0
+    while written < len(data):
+        written += os.write(dst_fd, data[written:])
+    return written
+
+# Fastest first: copy_file_range can stay inside the filesystem (or even the NFS server), sendfile at least
+# stays inside the kernel, and read/write works everywhere.
+DATA_TRANSFERS = [
+    transfer for transfer, available in (
+        (copy_range_chunk, hasattr(os, "copy_file_range")),
+        (sendfile_chunk, hasattr(os, "sendfile")),
+        (read_write_chunk, True),
+    ) if available
 ]
-if missing_setting_errors:
-    logger.critical("\n".join(missing_setting_errors) + "\n")
-    logger.critical("Don't see some of those setting in your config file? Delete it and allow it to regenerate.")
-    exit()
-
-if not ROOT_FOLDER_PATH.exists():
-    logger.critical("Root folder path doesn't actually exist, double check your spelling.")
-    exit()
-if not REAL_MIRROR_FOLDER.exists():
-    logger.info(f"Existing .Mirror folder not found in '{MIRROR_FOLDER_PATH}', creating one now!")
-    REAL_MIRROR_FOLDER.mkdir()
-
-logger.info(f"Using folder '{ROOT_FOLDER_PATH}' as root folder")
-logger.info(f"Using folder '{REAL_MIRROR_FOLDER}' as mirror folder")
-
-logger.info("Erasing previous mirror")
-for fsobj in REAL_MIRROR_FOLDER.iterdir():
-    logger.debug(f"Deleting file '{fsobj.name}' from previous mirror..")
-    fsobj.unlink()
-    
-logger.info("Updating mirror")
-def mirror_folder(path: Path):
-    for i,fsobj in enumerate(path.iterdir()):
-        if fsobj.name.startswith(".") and fsobj.name not in EXCLUSION_OVERRIDES:
-            logger.debug(f"Skipping folder '{fsobj.name}' because it starts with '.' and it is not added as an exclusion override.")
+
+def copy_file_data(source: str, source_stat: os.stat_result, target: str, hasher=None):
+    """Copy the contents of 'source' to 'target'. With a 'hasher' the bytes pass through this process, so they can be hashed on the way."""
+    start = time.perf_counter()
+    count("open", 2)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        if source_stat.st_size and hasattr(os, "posix_fallocate"):
+            try:
+                # Reserve the space in one go so big files don't end up fragmented.
+                os.posix_fallocate(dst_fd, 0, source_stat.st_size)
+            except OSError:
+                pass
+        copied = 0
+        transfers = DATA_TRANSFERS if hasher is None else [lambda src_fd, dst_fd: read_write_chunk(src_fd, dst_fd, hasher)]
+        for transfer in transfers:
+            try:
+                while (sent := transfer(src_fd, dst_fd)) > 0:
+                    copied += sent
+                break
+            except OSError as e:
+                if transfer is transfers[-1] or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+        # The source may have shrunk since it was stat'ed, drop whatever was preallocated past the end.
+        os.ftruncate(dst_fd, copied)
+    elapsed = time.perf_counter() - start
+    file_logger.debug(f"Copied {copied / 1024 / 1024:.1f} MiB of '{os.path.basename(source)}' in {elapsed:.3f}s ({copied / 1024 / 1024 / max(elapsed, 1e-9):.1f} MiB/s)")
+
+def remove_target(target: str):
+    # Never write through an existing mirror file, it might be a hardlink to the source.
+    count("unlink")
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+
+def probe_copy_strategy() -> str:
+    if ROOT_FOLDER_PATH.stat().st_dev != REAL_MIRROR_FOLDER.stat().st_dev:
+        return "copy"
+    probe = os.path.join(mirror_folder_path, ".mirror-probe")
+    try:
+        with open(probe, "wb") as f:
+            f.write(b"probe")
+        try:
+            reflink_file(probe, probe + "-reflink")
+            return "reflink"
+        except OSError:
+            pass
+        try:
+            os.link(probe, probe + "-hardlink")
+            return "hardlink"
+        except OSError:
+            return "copy"
+    finally:
+        for leftover in (probe, probe + "-reflink", probe + "-hardlink"):
+            remove_target(leftover)
+
+def place_file(strategy: str, source: str, source_stat: os.stat_result, target: str, hash_copy: bool) -> bytes | None:
+    """Put 'source' in the mirror as 'target' using 'strategy'. With 'hash_copy' the hash of what was copied is returned."""
+    count(f"{strategy}_files")
+    digest = None
+    if strategy == "hardlink":
+        # The mirrored file is the original, there's nothing to verify later.
+        os.link(source, target)
+        return None
+    if strategy == "reflink":
+        reflink_file(source, target)
+        # Nothing was read to make the copy, so this is the only read.
+        if hash_copy:
+            digest = file_digest(source, source_stat.st_size)
+    else:
+        hasher = new_hasher(HASH_ALGORITHM) if hash_copy else None
+        copy_file_data(source, source_stat, target, hasher)
+        digest = hasher and hasher.digest()
+    os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return digest
+
+def copy_file(source: str, source_stat: os.stat_result, target: str, hash_copy: bool = False) -> bytes | None:
+    remove_target(target)
+    for strategy in file_strategies:
+        try:
+            return place_file(strategy, source, source_stat, target, hash_copy)
+        except OSError as e:
+            # Don't leave a half written file behind for the next run to mistake as mirrored.
+            remove_target(target)
+            if strategy == file_strategies[-1] or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            file_logger.debug(f"Could not {strategy} file '{os.path.basename(source)}' ({e.strerror}), falling back to {file_strategies[file_strategies.index(strategy) + 1]}..")
+
+def reuse_file(name: str, target: str) -> bool:
+    """Hardlink the previous mirror's file 'name' into the staged mirror as 'target', or return False if that can't be done."""
+    try:
+        os.link(os.path.join(reuse_folder_path, name), target)
+    except OSError as e:
+        file_logger.debug(f"Could not reuse file '{name}' from the previous mirror ({e.strerror}), copying it instead..")
+        return False
+    count("reused_files")
+    return True
+
+def stat_source(source: str) -> os.stat_result:
+    count("stat")
+    # With SYMLINKS = 'link' a symlink is the file being mirrored, not what it points at.
+    return os.lstat(source) if SYMLINKS == "link" else os.stat(source)
+
+def sync_link(source: str, source_stat: os.stat_result, name: str, known: tuple | None) -> tuple[bool, tuple]:
+    target = os.path.join(mirror_folder_path, name)
+    entry = (name, source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_dev, source_stat.st_ino, None)
+    if not reuse_folder_path and known is not None and known[:5] == entry[:5]:
+        return False, known
+    # The mirror is flat, a relative link (or one under a relative ROOT_FOLDER_PATH) would point somewhere else from there.
+    link_target = os.path.abspath(os.path.join(os.path.dirname(source), os.readlink(source)))
+    file_logger.debug(f"Linking '{target}' to '{link_target}' ..")
+    remove_target(target)
+    os.symlink(link_target, target)
+    count("symlinks")
+    return True, entry
+
+def sync_file(source: str, name: str, known: tuple | None, source_stat: os.stat_result | None = None) -> tuple[bool, tuple]:
+    """Copy 'source' to the mirror as 'name' unless it's up to date, returning whether it was copied and its manifest entry.
+
+    'known' is the entry the manifest had for this file. When the file still matches it the mirror isn't even looked at.
+    """
+    if source_stat is None:
+        source_stat = stat_source(source)
+    if stat.S_ISLNK(source_stat.st_mode):
+        return sync_link(source, source_stat, name, known)
+    target = os.path.join(mirror_folder_path, name)
+    entry = (name, source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_dev, source_stat.st_ino, None)
+    if deduplicating:
+        return sync_deduplicated(source, source_stat, name, known, entry)
+    if known is not None and known[:5] == entry[:5]:
+        if not reuse_folder_path:
+            file_logger.debug(f"Skipping file '{os.path.basename(source)}' because it didn't change since the last run.")
+            return False, known
+        if reuse_file(name, target):
+            return False, known
+    # Only touched, or moved to another inode: the mirror file is still the one the stored hash is of.
+    known_digest = known[5] if known is not None and known[0] == name else None
+    copied, digest = update_target(source, source_stat, name, HASH_COPIES, known_digest)
+    return copied, entry[:5] + (digest,)
+
+def update_target(source: str, source_stat: os.stat_result, name: str, hash_copy: bool, known_digest: bytes | None = None) -> tuple[bool, bytes | None]:
+    """Copy 'source' to the mirror as 'name' unless the mirror file is up to date, returning whether it was copied and its hash.
+
+    The hash is the one taken while copying, or for an up to date mirror file the one taken to compare it (else 'known_digest').
+    """
+    target = os.path.join(mirror_folder_path, name)
+    # After a full erase the target is simply missing, so this costs one failed stat there.
+    unchanged, digest = is_unchanged(source, source_stat, os.path.join(reuse_folder_path or mirror_folder_path, name))
+    if unchanged:
+        if not reuse_folder_path:
+            file_logger.debug(f"Skipping file '{os.path.basename(source)}' because '{target}' is up to date.")
+            return False, digest or known_digest
+        if reuse_file(name, target):
+            return False, digest or known_digest
+    file_logger.debug(f"Copying file '{os.path.basename(source)}' to '{target}' ..")
+    return True, copy_file(source, source_stat, target, hash_copy)
+
+def claim_content(digest: bytes, name: str) -> tuple[str, threading.Event]:
+    """Make the mirror file 'name' the one holding the contents 'digest', unless another file already does. Returns the holder."""
+    with content_lock:
+        holder = content_holders.get(digest)
+        if holder is not None and holder[0] != name:
+            return holder
+        forget_content(name)
+        content_holders[digest] = holder = (name, threading.Event())
+        held_contents[name] = digest
+        return holder
+
+def forget_content(name: str):
+    # Callers hold content_lock.
+    digest = held_contents.pop(name, None)
+    if digest is not None and content_holders.get(digest, ("",))[0] == name:
+        del content_holders[digest]
+
+def link_to_holder(digest: bytes, holder: tuple[str, threading.Event], target: str) -> bool:
+    # The holder is being placed by another worker right now, it's only linked to once that's done.
+    holder[1].wait()
+    with content_lock:
+        if content_holders.get(digest) is not holder:
+            return False
+    remove_target(target)
+    try:
+        os.link(os.path.join(mirror_folder_path, holder[0]), target)
+    except OSError as e:
+        file_logger.debug(f"Could not link '{target}' to '{holder[0]}' ({e.strerror}), copying it instead..")
+        return False
+    return True
+
+def sync_deduplicated(source: str, source_stat: os.stat_result, name: str, known: tuple | None, entry: tuple) -> tuple[bool, tuple]:
+    """sync_file with DEDUPLICATE: a file with the same contents as one already in the mirror becomes a hardlink to it."""
+    target = os.path.join(mirror_folder_path, name)
+    # The manifest doubles as the hash cache, a file that didn't change since it was hashed isn't hashed again.
+    digest = known[5] if known is not None and known[:5] == entry[:5] and known[5] is not None else file_digest(source, source_stat.st_size)
+    entry = entry[:5] + (digest,)
+    holder = claim_content(digest, name)
+    try:
+        # Same contents as last time (maybe only touched), the mirror already has them.
+        if known is not None and known[0] == name and known[5] == digest and (not reuse_folder_path or reuse_file(name, target)):
+            file_logger.debug(f"Skipping file '{os.path.basename(source)}' because its contents didn't change since the last run.")
+            return False, entry
+        if holder[0] != name and link_to_holder(digest, holder, target):
+            file_logger.debug(f"Linked file '{os.path.basename(source)}' to '{holder[0]}' because they have the same contents.")
+            count("deduplicated_files")
+            count("deduplicated_bytes", source_stat.st_size)
+            return True, entry
+        # The contents were just hashed, no need to do it again while copying.
+        return update_target(source, source_stat, name, False)[0], entry
+    except OSError:
+        if holder[0] == name:
+            with content_lock:
+                forget_content(name)
+        raise
+    finally:
+        if holder[0] == name:
+            holder[1].set()
+
+class Manifest:
+    """What's known about every mirrored file, keyed by its path relative to the root.
+
+    Entries are (mirror name, size, mtime_ns, device, inode, hash or None). They're stored as columns
+    (a string list and typed arrays) and only turned into tuples when asked for, which is what keeps
+    loading millions of them well under a second.
+
+    Every mirrored folder also gets (mtime_ns or None, first row, row count, subfolder names), with the rows
+    of its files saved next to each other, so a folder that didn't change can be mirrored without listing it.
+    """
+
+    VERSION = 2
+    # size, mtime_ns, device, inode
+    NUMBER_TYPES = ("q", "q", "Q", "Q")
+
+    def __init__(self):
+        self.rows: dict[str, int] = {}
+        self.relatives: list[str] = []
+        self.names: list[str] = []
+        self.numbers = [array(typecode) for typecode in self.NUMBER_TYPES]
+        self.hashes: list[bytes | None] = []
+        self.folders: dict[str, tuple[int | None, int, int, tuple[str, ...]]] = {}
+        # Relative paths by (device, inode), (size, hash) and (size,) of the hashed files, see files_like().
+        self.index: dict[tuple, set[str]] | None = None
+        self.index_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, relative: str) -> bool:
+        return relative in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    def entry(self, row: int) -> tuple:
+        size, mtime_ns, device, inode = self.numbers
+        return self.names[row], size[row], mtime_ns[row], device[row], inode[row], self.hashes[row]
+
+    def get(self, relative: str) -> tuple | None:
+        row = self.rows.get(relative)
+        return None if row is None else self.entry(row)
+
+    def values(self):
+        return map(self.entry, self.rows.values())
+
+    def items(self):
+        return ((relative, self.entry(row)) for relative, row in self.rows.items())
+
+    def total_size(self) -> int:
+        sizes = self.numbers[0]
+        if len(sizes) == len(self.rows):
+            return sum(sizes)
+        return sum(sizes[row] for row in self.rows.values())
+
+    def __setitem__(self, relative: str, entry: tuple):
+        if self.index is not None:
+            with self.index_lock:
+                self.add_to_index(relative, entry)
+        row = self.rows.get(relative)
+        if row is None:
+            self.rows[relative] = len(self.names)
+            self.relatives.append(relative)
+            self.names.append(entry[0])
+            self.hashes.append(entry[5])
+            for column, value in zip(self.numbers, entry[1:5]):
+                column.append(value)
+            return
+        self.names[row] = entry[0]
+        self.hashes[row] = entry[5]
+        for column, value in zip(self.numbers, entry[1:5]):
+            column[row] = value
+
+    def pop(self, relative: str, default=None):
+        # The row stays behind in the columns until the next save, which only writes rows still in use.
+        row = self.rows.pop(relative, None)
+        return default if row is None else self.entry(row)
+
+    def add_to_index(self, relative: str, entry: tuple):
+        keys = [(entry[3], entry[4])]
+        if entry[5] is not None:
+            keys += [(entry[1],), (entry[1], entry[5])]
+        for key in keys:
+            self.index.setdefault(key, set()).add(relative)
+
+    def files_like(self, key: tuple) -> set[str]:
+        """The relative paths of the files with 'key': (device, inode), (size, hash) or (size,) for any file of that size with a hash.
+
+        Built the first time it's asked for, and never pruned, so the entries have to be checked again.
+        """
+        with self.index_lock:
+            if self.index is None:
+                self.index = {}
+                for relative, entry in self.items():
+                    self.add_to_index(relative, entry)
+            return set(self.index.get(key, ()))
+
+    def folder_snapshot(self, relative_folder: str, mtime_ns: int) -> tuple[dict[str, str], tuple[str, ...]] | None:
+        """The files (relative path to mirror name) and subfolders of a folder, if its mtime says they're still the same."""
+        folder = self.folders.get(relative_folder)
+        if folder is None or folder[0] != mtime_ns:
+            return None
+        _mtime_ns, first, count, subfolders = folder
+        return {self.relatives[row]: self.names[row] for row in range(first, first + count)}, subfolders
+
+    def dump(self, f, key: tuple, layout: list[tuple[str, int | None, list[str], list[str]]]):
+        """Save with the rows grouped by the (relative folder, mtime_ns, file relative paths, subfolder names) in 'layout'.
+
+        The manifest is rearranged the same way, afterwards it's exactly what load() would return.
+        """
+        rows = []
+        folders = []
+        for relative_folder, mtime_ns, relatives, subfolders in layout:
+            folder_rows = [self.rows[relative] for relative in relatives if relative in self.rows]
+            if len(folder_rows) != len(relatives):
+                # A file that failed to copy has no entry, so the folder must be listed again next time.
+                mtime_ns = None
+            folders.append((relative_folder, mtime_ns, len(rows), len(folder_rows), tuple(subfolders)))
+            rows += folder_rows
+        if len(rows) != len(self.rows):
+            placed = set(rows)
+            rows += [row for row in self.rows.values() if row not in placed]
+        # Usually nothing moved since the manifest was loaded.
+        if rows != list(range(len(self.relatives))):
+            self.relatives = [self.relatives[row] for row in rows]
+            self.names = [self.names[row] for row in rows]
+            self.numbers = [array(column.typecode, [column[row] for row in rows]) for column in self.numbers]
+            self.hashes = [self.hashes[row] for row in rows]
+            self.rows = dict(zip(self.relatives, range(len(rows))))
+        self.folders = {relative_folder: details for relative_folder, *details in folders}
+        marshal.dump((
+            self.VERSION,
+            key,
+            folders,
+            "\0".join(self.relatives).encode("utf-8", "surrogateescape"),
+            "\0".join(self.names).encode("utf-8", "surrogateescape"),
+            *[column.tobytes() for column in self.numbers],
+            self.hashes,
+        ), f)
+
+    @classmethod
+    def load(cls, f, key: tuple) -> "Manifest | None":
+        version, stored_key, folders, relatives, names, *numbers, hashes = marshal.load(f)
+        if version != cls.VERSION or stored_key != key:
+            return None
+        manifest = cls()
+        manifest.folders = {relative_folder: details for relative_folder, *details in folders}
+        if not hashes:
+            return manifest
+        manifest.relatives = relatives.decode("utf-8", "surrogateescape").split("\0")
+        manifest.rows = dict(zip(manifest.relatives, range(len(manifest.relatives))))
+        manifest.names = names.decode("utf-8", "surrogateescape").split("\0")
+        for column, data in zip(manifest.numbers, numbers):
+            column.frombytes(data)
+        manifest.hashes = hashes
+        return manifest
+
+def manifest_key() -> tuple:
+    # Entries only describe the mirror if the names were made the same way.
+    return (str(ROOT_FOLDER_PATH), PATH_SEPARATOR, PRESERVE_FILE_NAMES, tuple(sorted(EXCLUSION_OVERRIDES)), SYMLINKS, tuple(EXCLUDE), tuple(INCLUDE), HASH_ALGORITHM)
+
+def manifest_file_id(path: Path) -> tuple:
+    manifest_stat = os.stat(path)
+    return manifest_key(), manifest_stat.st_dev, manifest_stat.st_ino, manifest_stat.st_mtime_ns, manifest_stat.st_size
+
+def current_manifest() -> Manifest | None:
+    """The manifest saved in the mirror, taken from memory if this process was the last to save (or read) it."""
+    global known_manifest
+    try:
+        file_id = manifest_file_id(REAL_MIRROR_FOLDER / MANIFEST_NAME)
+    except OSError:
+        file_id = None
+    if file_id is not None and known_manifest is not None and known_manifest[0] == file_id:
+        logger.debug("Using the manifest kept in memory.")
+        count("manifests_kept")
+        return known_manifest[1]
+    loaded = load_manifest()
+    known_manifest = None if loaded is None or file_id is None else (file_id, loaded)
+    return loaded
+
+def load_manifest() -> Manifest | None:
+    """Read the manifest written by the previous run, or None if there's no usable one."""
+    try:
+        with open(REAL_MIRROR_FOLDER / MANIFEST_NAME, "rb") as f:
+            loaded = Manifest.load(f, manifest_key())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable manifest in '{REAL_MIRROR_FOLDER}': {e}")
+        return None
+    if loaded is None:
+        logger.debug("Ignoring manifest from a different version or configuration.")
+    return loaded
+
+def save_manifest():
+    global known_manifest
+    path = Path(mirror_folder_path) / MANIFEST_NAME
+    layout = [
+        (folder[root_prefix_length:], folder_snapshots[folder][0], list(files), folder_snapshots[folder][1])
+        for folder, files in folder_files.items()
+    ]
+    with open(path.with_name(MANIFEST_NAME + ".tmp"), "wb") as f:
+        manifest.dump(f, manifest_key(), layout)
+    # Replace in one step, a crash mid-write must not leave a truncated manifest behind.
+    os.replace(path.with_name(MANIFEST_NAME + ".tmp"), path)
+    # Renaming a staged mirror into place keeps the file as it is, so this still matches it afterwards.
+    known_manifest = (manifest_file_id(path), manifest)
+
+class Inotify:
+    """Minimal ctypes binding for the parts of inotify(7) the watch mode needs."""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+    # Plain IN_MODIFY fires for every write(), waiting for IN_CLOSE_WRITE is enough.
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_EXCL_UNLINK
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.folders: dict[int, str] = {}
+        self.descriptors: dict[str, int] = {}
+
+    def add(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.folders[wd] = path
+        self.descriptors[path] = wd
+
+    def remove(self, path: str):
+        wd = self.descriptors.pop(path, None)
+        if wd is not None:
+            self.folders.pop(wd, None)
+            # Fails harmlessly when the kernel already dropped the watch because the folder is gone.
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> list[tuple[str | None, int, str]]:
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.IN_IGNORED:
+                    path = self.folders.pop(wd, None)
+                    if path is not None and self.descriptors.get(path) == wd:
+                        del self.descriptors[path]
+                    continue
+                events.append((self.folders.get(wd), mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+file_strategies: list[str] = []
+mirror_folder_path = ""
+deduplicating = False
+# For DEDUPLICATE, the mirror name (and an event set once it's placed) of the file holding each contents, by digest.
+content_holders: dict[bytes, tuple[str, threading.Event]] = {}
+# The digest every holder in 'content_holders' holds, by mirror name.
+held_contents: dict[str, bytes] = {}
+content_lock = threading.Lock()
+# Previous mirrors being deleted in the background, by path.
+deleting_mirrors: set[str] = set()
+# The current mirror while STAGED_BUILD builds the next one in 'mirror_folder_path', unchanged files are hardlinked from it.
+reuse_folder_path = ""
+root_folder_path = ""
+root_prefix_length = 0
+# Mirror names of the files directly inside every mirrored folder by their path relative to the root, keyed by the folder's path.
+folder_files: dict[str, dict[str, str]] = {}
+# The mtime_ns (None if too recent to trust) and mirrored subfolder names of every mirrored folder, keyed by the folder's path.
+folder_snapshots: dict[str, tuple[int | None, list[str]]] = {}
+manifest = Manifest()
+# The manifest last loaded or saved by this process, with the (manifest key, device, inode, mtime_ns, size) its file had then.
+# While the file is still the same the next update uses it instead of reading the file again.
+known_manifest: tuple[tuple, Manifest] | None = None
+# Set while plan_update() walks the root folder: the relative paths of the files that would be copied.
+planned_copies: list[str] | None = None
+LANE_NAMES = ["small", "medium", "huge"]
+# Copies handed to the workers of each lane and not reported yet, oldest first. Never more than COPY_QUEUE_SIZE per lane while walking.
+copy_jobs: list[deque[tuple[str, str, str, tuple | None, Future]]] = [deque() for _ in LANE_NAMES]
+# Copied, unchanged and failed files reported since the last finish_copy_jobs().
+copy_outcomes: Counter[str] = Counter()
+# Whether a file the manifest doesn't know might have been moved from one it does, see move_file().
+detect_moves = False
+# The manifest files found moved during this update (relative paths), so no two new files are taken for the same one.
+claimed_moves: set[str] = set()
+moves_lock = threading.Lock()
+# The mirror names the moved files were taken from, reported by report_copy_jobs().
+moved_names: set[str] = set()
+# Past this many hashed files of its size, a new file isn't hashed to look for the one it was moved from.
+MOVE_HASH_CANDIDATES = 8
+walked_dirs = 0
+walked_files = 0
+walk_stat_calls = 0
+pruned_dirs = 0
+# The (st_dev, st_ino) of every folder walked, so a folder reached twice (a symlink loop) is only mirrored once.
+visited_folders: set[tuple[int, int]] = set()
+# The (st_dev, st_ino) of every walked folder, keyed by the folder's path.
+folder_ids: dict[str, tuple[int, int]] = {}
+# Paths of the folders this walk failed to list. The files the manifest has below them weren't seen, but they aren't gone either.
+unlisted_folders: set[str] = set()
+watcher = None
+# Set once inotify ran out of watches, so that's only reported once.
+watches_exhausted = False
+
+def watch_folder(path: str) -> bool:
+    """Have the watcher report changes in 'path'. Returns False if the folder couldn't be watched because it's gone or unreadable."""
+    global watches_exhausted
+    try:
+        watcher.add(path)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            file_logger.debug(f"Could not watch folder '{path}': {e}")
+            return False
+        if not watches_exhausted:
+            logger.critical(f"Ran out of inotify watches at '{path}', changes in this and further folders are only mirrored by the next full update. "
+                            "Raise the limit with 'sysctl fs.inotify.max_user_watches=<more>'.")
+            watches_exhausted = True
+        count("unwatched_folders")
+    return True
+
+def mirror_folder(path: str, name_prefix: str, lanes: "CopyLanes", mtime_ns: int, rescan: bool = False):
+    """Mirror every file below 'path', whose mirror names all start with 'name_prefix'.
+
+    Folders are walked from a stack instead of recursively, so a deep tree doesn't run into Python's recursion limit.
+    One that can't be listed (its path too long for the OS, no permission) is logged and skipped, the walk goes on without it.
+    With 'rescan' only subfolders of 'path' that weren't mirrored before are walked into.
+    """
+    # The (path, name prefix, mtime_ns) of the folders still to walk.
+    stack = [(path, name_prefix, mtime_ns)]
+    while stack:
+        folder, folder_prefix, folder_mtime_ns = stack.pop()
+        subfolders = list_folder(folder, folder_prefix, lanes, folder_mtime_ns, rescan)
+        rescan = False
+        # Reversed, so subfolders are walked in the order they were listed.
+        stack += reversed(subfolders)
+
+def enter_folder(path: str, folder_stat: os.stat_result) -> bool:
+    """Claim a folder for this walk, or return False if it was already reached another way (a symlink, a bind mount)."""
+    folder_id = (folder_stat.st_dev, folder_stat.st_ino)
+    if folder_id in visited_folders:
+        file_logger.debug(f"Skipping folder '{path}' because it was already mirrored through another path.")
+        count("revisited_folders")
+        return False
+    visited_folders.add(folder_id)
+    folder_ids[path] = folder_id
+    return True
+
+def list_folder(path: str, name_prefix: str, lanes: "CopyLanes", mtime_ns: int, rescan: bool) -> list[tuple[str, str, int]]:
+    """Queue the files directly inside 'path' and return the subfolders to walk next as (path, name prefix, mtime_ns).
+
+    Entry types come from the directory listing itself (d_type on Linux), so the walk only
+    needs an extra stat for symlinks and folders. A folder whose 'mtime_ns' matches the manifest
+    has the same entries as last time, so it isn't listed at all and its files come from the manifest.
+    A folder that fails to list is never snapshotted and goes in unlisted_folders, so it's listed again next time.
+    """
+    global walked_dirs, walked_files, walk_stat_calls, pruned_dirs
+    walked_dirs += 1
+    # Watch before listing, so nothing created during the listing is missed. A folder that can't be watched is listed to find out why.
+    watched = watcher is None or watch_folder(path)
+    snapshot_mtime_ns = None if mtime_ns > time.time_ns() - RACY_MTIME_NS else mtime_ns
+    # Whether a file is excluded by its size or age can change without its folder changing.
+    snapshot = None if rescan or not watched or exclude_rules.predicates or include_rules.predicates else manifest.folder_snapshot(path[root_prefix_length:], mtime_ns)
+    walk_next = []
+    if snapshot is not None:
+        files, subfolders = snapshot
+        walk_stat_calls += len(subfolders)
+        try:
+            subfolder_stats = [os.stat(os.path.join(path, subfolder)) for subfolder in subfolders]
+        except OSError as e:
+            # A linked folder's target can go without this folder changing, the listing finds out what's there now.
+            file_logger.debug(f"Listing folder '{path}' even though it didn't change: {e}")
+            snapshot = None
+    if snapshot is not None:
+        pruned_dirs += 1
+        for relative, file_name in files.items():
+            walked_files += 1
+            source = os.path.join(root_folder_path, relative)
+            queue_copy(lanes, source, relative, file_name, manifest.get(relative))
+        folder_files[path] = files
+        folder_snapshots[path] = (snapshot_mtime_ns, list(subfolders))
+        for subfolder, subfolder_stat in zip(subfolders, subfolder_stats):
+            subfolder_path = os.path.join(path, subfolder)
+            if enter_folder(subfolder_path, subfolder_stat):
+                walk_next.append((subfolder_path, f"{name_prefix}{subfolder}{PATH_SEPARATOR}", subfolder_stat.st_mtime_ns))
+        return walk_next
+
+    # Only used for the unpreserved '<folder>-<index>.<ext>' names, where the root folder is '.'.
+    folder_label = name_prefix.removesuffix(PATH_SEPARATOR) or "."
+    # The mirror (and staged or old ones) might be inside the root folder, they're never mirrored whatever EXCLUDE says.
+    holds_mirror = os.path.abspath(path) == os.path.abspath(MIRROR_FOLDER_PATH)
+    files = {}
+    subfolders = []
+    try:
+        with os.scandir(path) as entries:
+            for i,entry in enumerate(entries):
+                name = entry.name
+                if holds_mirror and name.startswith(REAL_MIRROR_FOLDER.name):
+                    continue
+                is_symlink = entry.is_symlink()
+                if is_symlink and SYMLINKS == "skip":
+                    file_logger.debug(f"Skipping '{name}' because it is a symlink.")
+                    count("excluded_entries")
+                    continue
+                # Mirrored as a link, whatever it points at.
+                is_link_file = is_symlink and SYMLINKS == "link"
+                if is_symlink and not is_link_file:
+                    walk_stat_calls += 1
+                relative = entry.path[root_prefix_length:]
+                if not is_link_file and entry.is_dir():
+                    if is_excluded(relative, name, True, entry):
+                        file_logger.debug(f"Skipping folder '{relative}' because it matches EXCLUDE.")
+                        count("excluded_folders")
+                        continue
+                    if rescan and entry.path in folder_files:
+                        subfolders.append(name)
+                        continue
+                    # Symlinks were already stat'ed to find out they point at a folder, DirEntry kept the result.
+                    if not is_symlink:
+                        walk_stat_calls += 1
+                    subfolder_stat = entry.stat()
+                    if enter_folder(entry.path, subfolder_stat):
+                        subfolders.append(name)
+                        walk_next.append((entry.path, f"{name_prefix}{name}{PATH_SEPARATOR}", subfolder_stat.st_mtime_ns))
+                    continue
+                if not is_link_file and not entry.is_file():
+                    file_logger.debug(f"Skipping '{name}' because it is neither a file nor a folder.")
+                    count("excluded_entries")
+                    continue
+                if is_excluded(relative, name, False, entry):
+                    file_logger.debug(f"Skipping file '{relative}' because it matches EXCLUDE.")
+                    count("excluded_files")
+                    continue
+
+                walked_files += 1
+                file_name = f"{name_prefix}{name}" if PRESERVE_FILE_NAMES else f"{folder_label}-{i}{os.path.splitext(name)[1]}"
+                files[relative] = file_name
+                queue_copy(lanes, entry.path, relative, file_name, manifest.get(relative))
+    except OSError as e:
+        # Too long a path, no permission or gone already. What was found so far is mirrored, the rest is kept (see unlisted_files()).
+        logger.error(f"Could not list folder '{path}': {e}")
+        count("unreadable_folders")
+        unlisted_folders.add(path)
+        snapshot_mtime_ns = None
+    folder_files[path] = files
+    folder_snapshots[path] = (snapshot_mtime_ns, subfolders)
+    return walk_next
+
+def unlisted_files(relatives) -> set[str]:
+    """The relative paths in 'relatives' below a folder in unlisted_folders."""
+    if not unlisted_folders:
+        return set()
+    prefixes = tuple(os.path.join(folder[root_prefix_length:], "") for folder in unlisted_folders)
+    return {relative for relative in relatives if relative.startswith(prefixes)}
+
+def keep_unlisted(vanished: set[str]) -> set[str]:
+    """Take the files below folders that couldn't be listed out of 'vanished', returning their mirror names.
+
+    Their mirror files and manifest entries stay until the folder can be listed again, a staged mirror gets hardlinks to them.
+    """
+    kept_names = set()
+    for relative in unlisted_files(vanished):
+        vanished.discard(relative)
+        name = manifest.get(relative)[0]
+        if reuse_folder_path:
+            try:
+                os.link(os.path.join(reuse_folder_path, name), os.path.join(mirror_folder_path, name), follow_symlinks=False)
+            except OSError as e:
+                # Without its mirror file the entry would claim a copy that isn't there.
+                file_logger.debug(f"Could not keep file '{name}' ({e.strerror}), it's copied once its folder can be listed..")
+                manifest.pop(relative)
+                continue
+        kept_names.add(name)
+    count("kept_files", len(kept_names))
+    return kept_names
+
+def sample_folder(path: str) -> tuple[int, int, list[str]]:
+    """The number of files that would be mirrored directly inside 'path', their bytes and the subfolders that would be walked into."""
+    holds_mirror = os.path.abspath(path) == os.path.abspath(MIRROR_FOLDER_PATH)
+    files = 0
+    size = 0
+    subfolders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if holds_mirror and entry.name.startswith(REAL_MIRROR_FOLDER.name):
+                continue
+            is_symlink = entry.is_symlink()
+            if is_symlink and SYMLINKS == "skip":
+                continue
+            relative = entry.path[root_prefix_length:]
+            if entry.is_dir(follow_symlinks=False):
+                if not is_excluded(relative, entry.name, True, entry):
+                    subfolders.append(entry.path)
+                continue
+            # Linked folders are left out, a symlink loop would make for an endless walk.
+            if is_symlink and SYMLINKS == "follow" and not entry.is_file():
+                continue
+            if (is_symlink or entry.is_file()) and not is_excluded(relative, entry.name, False, entry):
+                files += 1
+                size += entry.stat(follow_symlinks=SYMLINKS != "link").st_size
+    return files, size, subfolders
+
+def estimate_files(samples: int) -> tuple[int, int]:
+    """Guess how many files and bytes below the root folder would be mirrored, from about 'samples' walks down it.
+
+    The walks are spread evenly over the subfolders of every folder, while there are more walks than subfolders
+    every subfolder gets its share. Past that, each walk goes down a random subfolder, which then stands for all
+    of its siblings that weren't picked. Averaged like that (Knuth's estimator) it comes out at the size of the whole tree.
+    """
+    from random import Random
+    rng = Random()
+    total_files = 0
+    total_size = 0
+    listed = 0
+    # (path, walks going down it, how many folders it stands for)
+    stack = [(root_folder_path, samples, 1.0)]
+    while stack:
+        path, walks, weight = stack.pop()
+        listed += 1
+        try:
+            files, size, subfolders = sample_folder(path)
+        except OSError:
             continue
-        if not fsobj.is_file():
-            mirror_folder(fsobj)
+        total_files += weight * files
+        total_size += weight * size
+        if walks >= len(subfolders):
+            for i, subfolder in enumerate(subfolders):
+                stack.append((subfolder, walks // len(subfolders) + (i < walks % len(subfolders)), weight))
+        else:
+            stack += ((subfolder, 1, weight * len(subfolders) / walks) for subfolder in rng.sample(subfolders, walks))
+    count("estimate_folders", listed)
+    return round(total_files), round(total_size)
+
+def claim_moved(relative: str) -> bool:
+    """Take the manifest file 'relative' as the one a new file was moved from, unless its source is still there or it was taken already."""
+    try:
+        os.lstat(os.path.join(root_folder_path, relative))
+        # Still there, the new file is a hardlink or a copy of it.
+        return False
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    with moves_lock:
+        if relative in claimed_moves:
+            return False
+        claimed_moves.add(relative)
+    return True
+
+def find_moved(source: str, source_stat: os.stat_result) -> tuple | None:
+    """The manifest entry of a vanished file that 'source' is: the same device and inode with the same size and mtime, or the same size and stored hash."""
+    size = source_stat.st_size
+    for relative in manifest.files_like((source_stat.st_dev, source_stat.st_ino)):
+        entry = manifest.get(relative)
+        if entry is not None and entry[1:5] == (size, source_stat.st_mtime_ns, source_stat.st_dev, source_stat.st_ino) and claim_moved(relative):
+            return entry
+    if HASH_ALGORITHM in WEAK_HASH_ALGORITHMS:
+        return None
+    candidates = manifest.files_like((size,))
+    # Every new file of a common size would be hashed, and its candidates stat'ed, for a file that was most likely just added.
+    if not candidates or len(candidates) > MOVE_HASH_CANDIDATES or all(os.path.lexists(os.path.join(root_folder_path, relative)) for relative in candidates):
+        return None
+    digest = file_digest(source, size)
+    for relative in manifest.files_like((size, digest)):
+        entry = manifest.get(relative)
+        if entry is not None and entry[1] == size and entry[5] == digest and claim_moved(relative):
+            return entry
+    return None
+
+def move_file(source: str, source_stat: os.stat_result, name: str) -> tuple[str, tuple] | None:
+    """Give the new file 'source' the mirror file of the file it was moved from, if it was.
+
+    Returns the mirror name that was taken and the new manifest entry, or None if the file has to be copied.
+    """
+    # A moved relative symlink would point somewhere else, so links are always made again.
+    if stat.S_ISLNK(source_stat.st_mode):
+        return None
+    old = find_moved(source, source_stat)
+    if old is None:
+        return None
+    target = os.path.join(mirror_folder_path, name)
+    if reuse_folder_path or old[0] != name:
+        file_logger.debug(f"Moving file '{old[0]}' to '{name}' because its source was moved..")
+        try:
+            if reuse_folder_path:
+                # A staged mirror takes a hardlink, the previous mirror has to stay intact until it's swapped out.
+                os.link(os.path.join(reuse_folder_path, old[0]), target)
+            elif PRESERVE_FILE_NAMES:
+                os.rename(os.path.join(mirror_folder_path, old[0]), target)
+                with content_lock:
+                    forget_content(old[0])
+            else:
+                # Unpreserved '<folder>-<index>' names get reused, another file might be taking over the old one right now.
+                # It's linked instead and removed with the stale files if nothing did (see remove_moved()).
+                remove_target(target)
+                os.link(os.path.join(mirror_folder_path, old[0]), target)
+                target_stat = os.lstat(target)
+                if (target_stat.st_size, target_stat.st_mtime_ns) != old[1:3]:
+                    raise OSError(errno.ESTALE, "it was replaced", target)
+            if old[2] != source_stat.st_mtime_ns:
+                os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        except OSError as e:
+            file_logger.debug(f"Could not move file '{old[0]}' ({e.strerror}), copying it instead..")
+            return None
+    return old[0], (name, source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_dev, source_stat.st_ino, old[5])
+
+def plan_file(source: str, name: str, known: tuple | None) -> bool:
+    """Whether sync_file() would copy 'source' to the mirror as 'name', found out without copying or hashing anything."""
+    try:
+        source_stat = stat_source(source)
+    except OSError:
+        # Updating would try and fail, see the error it logs then.
+        return True
+    if known is not None and known[:5] == (name, source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_dev, source_stat.st_ino):
+        return False
+    if not INCREMENTAL or stat.S_ISLNK(source_stat.st_mode):
+        return True
+    count("stat")
+    try:
+        target_stat = os.lstat(os.path.join(mirror_folder_path, name))
+    except OSError:
+        return True
+    return stat.S_ISLNK(target_stat.st_mode) or (target_stat.st_size, target_stat.st_mtime_ns) != (source_stat.st_size, source_stat.st_mtime_ns)
+
+def timed_sync_file(source: str, name: str, known: tuple | None, source_stat: os.stat_result | None = None) -> tuple[bool, tuple]:
+    start = time.perf_counter_ns()
+    copied = False
+    entry = None
+    try:
+        copied, entry = sync_file(source, name, known, source_stat)
+        return copied, entry
+    finally:
+        with counts_lock:
+            counts["copy_busy_ns"] += time.perf_counter_ns() - start
+            progress["files"] += 1
+            if entry is not None:
+                progress["bytes"] += entry[1]
+                if copied:
+                    progress["copied_bytes"] += entry[1]
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02}m" if hours else f"{minutes}m {seconds:02}s" if minutes else f"{seconds}s"
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+def progress_line(first: tuple[float, int, int, int], last: tuple[float, int, int, int], expected: tuple[int, int] | None) -> str:
+    """Describe the progress between two (monotonic time, files, bytes, copied bytes) samples, the first one taken when the update started."""
+    elapsed = max(last[0] - first[0], 1e-9)
+    files, size, copied_size = (last[i] - first[i] for i in range(1, 4))
+    line = f"{files:,} file(s), {format_size(size)}"
+    if expected is not None and files < expected[0]:
+        line = f"{files:,} of about {expected[0]:,} file(s), {format_size(size)} of about {format_size(max(expected[1], size))}"
+    line += f", {files / elapsed:,.0f} file(s)/s, {format_size(copied_size / elapsed)}/s copied"
+    return line
+
+def report_progress(done: threading.Event, expected: tuple[int, int] | None):
+    # Reading the counters without the lock can be a file behind, that's close enough for this.
+    live = ch.stream.isatty()
+    interval = LIVE_PROGRESS_INTERVAL if live else PROGRESS_INTERVAL
+    start = (time.monotonic(), progress["files"], progress["bytes"], progress["copied_bytes"])
+    # The current speed and the time left come from the samples of the last PROGRESS_WINDOW_SECONDS.
+    samples = deque([start])
+    while not done.wait(interval):
+        sample = (time.monotonic(), progress["files"], progress["bytes"], progress["copied_bytes"])
+        samples.append(sample)
+        while sample[0] - samples[1][0] >= PROGRESS_WINDOW_SECONDS:
+            samples.popleft()
+        line = progress_line(start, sample, expected)
+        window = max(sample[0] - samples[0][0], 1e-9)
+        files_per_second = (sample[1] - samples[0][1]) / window
+        bytes_per_second = (sample[2] - samples[0][2]) / window
+        files_left = 0 if expected is None else expected[0] - (sample[1] - start[1])
+        bytes_left = 0 if expected is None else expected[1] - (sample[2] - start[2])
+        if files_left > 0 and files_per_second > 0:
+            # Both the files and their bytes have to be done, whichever takes longer at the current speed.
+            seconds_left = max(files_left / files_per_second, bytes_left / bytes_per_second if bytes_per_second > 0 else 0)
+            line += f", about {format_duration(seconds_left)} left"
+        if live:
+            ch.set_status(line)
+        else:
+            logger.info(f"Mirrored {line}")
+    if live:
+        ch.set_status("")
+
+@contextmanager
+def reporting_progress(expected: tuple[int, int] | None):
+    """Show how far the copy workers got every PROGRESS_INTERVAL seconds, live in a terminal.
+
+    With about how many files and bytes there are ('expected') the time left is guessed too.
+    """
+    if PROGRESS_INTERVAL <= 0:
+        yield
+        return
+    done = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(done, expected), name="progress", daemon=True)
+    reporter.start()
+    try:
+        yield
+    finally:
+        done.set()
+        reporter.join()
+
+def file_lane(size: int) -> int:
+    return 0 if size < LANE_SIZES[0] else 1 if size < LANE_SIZES[1] else 2
+
+class CopyLanes:
+    """The copy workers, a thread pool for each lane (LANE_NAMES) with LANE_WORKERS threads.
+
+    Small files are mostly waiting on metadata, huge ones on moving data. With pools of their own a huge file
+    only ever holds up other huge files, and the small ones keep flowing while it's copied.
+    """
+
+    def __init__(self):
+        self.executors = [
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"copy-{lane}")
+            for lane, workers in zip(LANE_NAMES, LANE_WORKERS)
+        ]
+
+    def submit(self, lane: int, fn, *args) -> Future:
+        return self.executors[lane].submit(fn, *args)
+
+    def shutdown(self, cancel: bool = False):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=cancel)
+
+    def __enter__(self) -> "CopyLanes":
+        return self
+
+    def __exit__(self, exc_type, *_exc_info):
+        # After an error the queued copies are dropped, only the running ones are waited for.
+        self.shutdown(cancel=exc_type is not None)
+
+def sync_file_in_lane(lane: int, source: str, name: str, known: tuple | None) -> tuple[bool | str, tuple] | tuple[int, os.stat_result]:
+    """timed_sync_file() for a file in 'lane'. One that turned out too big for it (new, or grown since the last run) isn't
+    copied here, this returns the lane it belongs in and its stat instead for report_copy_jobs() to hand it on.
+
+    A new file that was moved (see move_file()) isn't copied either, that returns the mirror name it was taken from.
+    """
+    source_stat = stat_source(source)
+    if known is None and detect_moves:
+        moved = move_file(source, source_stat, name)
+        if moved is not None:
+            return moved
+    lane_fits = file_lane(source_stat.st_size)
+    if lane_fits > lane:
+        return lane_fits, source_stat
+    return timed_sync_file(source, name, known, source_stat)
+
+def queue_copy(lanes: CopyLanes, source: str, relative: str, name: str, known: tuple | None):
+    """Hand a file to the copy workers of its lane, picked by the size the manifest knows (new files start with the small ones).
+
+    When COPY_QUEUE_SIZE files of a lane are waiting, wait for its oldest instead of finding more.
+    """
+    if planned_copies is not None:
+        lane = 0
+        job = lanes.submit(lane, plan_file, source, name, known)
+    else:
+        lane = 0 if known is None else file_lane(known[1])
+        job = lanes.submit(lane, sync_file_in_lane, lane, source, name, known)
+    add_copy_job(lanes, lane, (source, relative, name, known, job))
+    for other_lane, jobs in enumerate(copy_jobs):
+        if jobs and jobs[0][4].done():
+            report_copy_jobs(lanes, len(jobs), other_lane)
+
+def add_copy_job(lanes: CopyLanes, lane: int, copy_job: tuple):
+    copy_jobs[lane].append(copy_job)
+    if len(copy_jobs[lane]) > COPY_QUEUE_SIZE:
+        with timed_phase("queue_full"):
+            report_copy_jobs(lanes, COPY_QUEUE_SIZE, lane)
+
+def report_copy_jobs(lanes: CopyLanes, keep: int, lane: int):
+    """Report finished copies of 'lane' in the order the files were found (not the order the workers finished them), waiting for the oldest while more than 'keep' are left.
+
+    Files that turned out too big for 'lane' are handed on to theirs from here, so that lane's COPY_QUEUE_SIZE holds for them too.
+    """
+    jobs = copy_jobs[lane]
+    while jobs and (len(jobs) > keep or jobs[0][4].done()):
+        source, relative, name, known, job = jobs.popleft()
+        if planned_copies is not None:
+            if job.result():
+                planned_copies.append(relative)
             continue
-        if fsobj.suffix == ".ini":
-            logger.debug(f"Skipping file '{fsobj.name}' because it uses the file extension '.ini'.")
+        try:
+            result = job.result()
+            if isinstance(result[1], os.stat_result):
+                lane_fits, source_stat = result
+                count("handed_on_files")
+                job = lanes.submit(lane_fits, timed_sync_file, source, name, known, source_stat)
+                add_copy_job(lanes, lane_fits, (source, relative, name, known, job))
+                continue
+            copied, manifest[relative] = result
+            if isinstance(copied, str):
+                moved_names.add(copied)
+                outcome = "moved"
+            else:
+                outcome = "copied" if copied else "unchanged"
+            copy_outcomes[outcome] += 1
+            count(f"{outcome}_bytes", manifest.get(relative)[1])
+        except OSError as e:
+            logger.error(f"Failed to copy file '{source}': {e}")
+            manifest.pop(relative, None)
+            copy_outcomes["failed"] += 1
+
+def report_all_copy_jobs(lanes: CopyLanes):
+    # Smallest first, files are only ever handed on to bigger lanes.
+    for lane in range(len(copy_jobs)):
+        report_copy_jobs(lanes, 0, lane)
+
+def drop_copy_jobs():
+    """Forget the copies and moves an update that stopped halfway left, so the next one doesn't report them."""
+    for jobs in copy_jobs:
+        for *_, job in jobs:
+            job.cancel()
+        jobs.clear()
+    copy_outcomes.clear()
+    claimed_moves.clear()
+    moved_names.clear()
+
+def finish_copy_jobs() -> tuple[int, int, int]:
+    """Return how many files were copied, unchanged and failed since the last call, once report_all_copy_jobs() waited for them."""
+    outcomes = (copy_outcomes["copied"], copy_outcomes["unchanged"], copy_outcomes["failed"])
+    count("moved_files", copy_outcomes["moved"])
+    copy_outcomes.clear()
+    for outcome, outcome_count in zip(("copied", "unchanged", "failed"), outcomes):
+        count(f"{outcome}_files", outcome_count)
+    return outcomes
+
+def forget_files(files: dict[str, str]):
+    for relative in files:
+        manifest.pop(relative, None)
+
+def remove_mirrored(names: set[str], reason: str) -> int:
+    for name in names:
+        file_logger.debug(f"Deleting file '{name}' because {reason}..")
+        remove_target(os.path.join(mirror_folder_path, name))
+        with content_lock:
+            forget_content(name)
+    count("removed_files", len(names))
+    return len(names)
+
+def remove_moved(names: set[str]):
+    """Remove the mirror files moved files were linked from (the stale ones among 'names'), see move_file()."""
+    if reuse_folder_path or PRESERVE_FILE_NAMES:
+        # Renamed away already, or left in the previous mirror.
+        return
+    for name in names:
+        remove_target(os.path.join(mirror_folder_path, name))
+        with content_lock:
+            forget_content(name)
+
+def folder_name_prefix(path: str) -> str:
+    relative = os.path.relpath(path, root_folder_path)
+    return "" if relative == "." else relative.replace(os.sep, PATH_SEPARATOR) + PATH_SEPARATOR
+
+def path_events(paths) -> list[tuple[str, int, str]]:
+    """Turn paths below the root folder (absolute or relative to it) that were created, changed or deleted into events for apply_changes()."""
+    root = os.path.abspath(root_folder_path)
+    events = []
+    for path in paths:
+        relative = os.path.relpath(os.path.abspath(os.path.join(root, path)), root)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            raise ValueError(f"'{path}' is not inside the root folder '{root_folder_path}'.")
+        path = root_folder_path if relative == "." else os.path.join(root_folder_path, relative)
+        if path in folder_files and path != root_folder_path and not os.path.isdir(path):
+            events.append((os.path.dirname(path), Inotify.IN_ISDIR | Inotify.IN_DELETE, os.path.basename(path)))
             continue
+        # Listing the closest mirrored folder again finds what changed, walking into a new subfolder if that's where it is.
+        while path not in folder_files and path != root_folder_path:
+            path = os.path.dirname(path)
+        events.append((path, 0, ""))
+    return events
+
+def apply_changes(events: list[tuple[str | None, int, str]]) -> tuple[int, int, int, int, int]:
+    """Bring the mirror up to date with a batch of inotify events.
+
+    Every folder with an event is listed again (cheap, and the only way to keep unpreserved
+    '<folder>-<index>' names right), new subfolders are walked, removed ones are dropped.
+    """
+    dirty_folders = set()
+    gone_folders = set()
+    for folder, mask, name in events:
+        if folder is None:
+            continue
+        if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+            gone_folders.add(os.path.join(folder, name))
+        dirty_folders.add(folder)
+
+    # The files each changed or removed folder had before this batch, keyed by the folder's path.
+    previous_files = {}
+    for gone in gone_folders:
+        for path in [path for path in folder_files if path == gone or path.startswith(gone + os.sep)]:
+            previous_files[path] = folder_files.pop(path)
+            del folder_snapshots[path]
+            visited_folders.discard(folder_ids.pop(path, None))
+            if watcher is not None:
+                watcher.remove(path)
+
+    unlisted_folders.clear()
+    claimed_moves.clear()
+    moved_names.clear()
+    with CopyLanes() as lanes:
+        for folder in dirty_folders:
+            if folder not in folder_files:
+                continue
+            previous_files[folder] = folder_files[folder]
+            try:
+                mirror_folder(folder, folder_name_prefix(folder), lanes, os.stat(folder).st_mtime_ns, rescan=True)
+            except OSError as e:
+                # Usually the folder was removed while this batch was collected, its parent's event drops it.
+                logger.debug(f"Could not list folder '{folder}': {e}")
+        vanished = set()
+        stale_names = set()
+        for folder, files in previous_files.items():
+            # A removed folder might be back already, under the same path.
+            current = folder_files.get(folder, {})
+            if folder in unlisted_folders:
+                # What it had might well still be there.
+                current = folder_files[folder] = files | current
+            vanished |= files.keys() - current.keys()
+            stale_names |= set(files.values()) - set(current.values())
+        report_all_copy_jobs(lanes)
+    copy_counts = finish_copy_jobs()
+    forget_files(vanished)
+    removed_count = remove_mirrored(stale_names - moved_names, "its source no longer exists")
+    remove_moved(stale_names & moved_names)
+    return *copy_counts, len(moved_names), removed_count
+
+def mirror_watched_changes():
+    import select
+    events = watcher.read()
+    # Coalesce a burst of changes (say, a folder being extracted) into one pass over the mirror.
+    batch_started = time.monotonic()
+    while select.select([watcher.fd], [], [], WATCH_DEBOUNCE_MS / 1000)[0] and time.monotonic() - batch_started < WATCH_MAX_BATCH_SECONDS:
+        events += watcher.read()
+    if any(mask & Inotify.IN_Q_OVERFLOW for _folder, mask, _name in events):
+        logger.warning("Too many changes at once to keep track of, checking the whole root folder..")
+        events = [(folder, 0, "") for folder in folder_files]
+    copied_count, unchanged_count, failed_count, moved_count, removed_count = apply_changes(events)
+    if copied_count or moved_count or removed_count or failed_count:
+        logger.info(f"Copied {copied_count} file(s), moved {moved_count} file(s), removed {removed_count} file(s)")
+
+def exchange_folders(first: Path, second: Path) -> bool:
+    """Atomically swap two folders with renameat2(RENAME_EXCHANGE), or return False where that isn't supported."""
+    import ctypes
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+    if renameat2 is None:
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in UNSUPPORTED_ERRNOS:
+        return False
+    raise OSError(error, os.strerror(error), str(first))
+
+def delete_folder(path: str):
+    # Mirrors are flat, but whatever else ended up in one (folders included) goes too.
+    import shutil
+    try:
+        shutil.rmtree(path)
+    except OSError as e:
+        logger.warning(f"Could not delete previous mirror '{path}': {e}")
+    finally:
+        deleting_mirrors.discard(path)
+
+def old_mirror_path() -> Path:
+    return MIRROR_FOLDER_PATH / f"{OLD_MIRROR_PREFIX}{time.time_ns()}"
+
+def swap_in_staged_mirror(staging: Path):
+    """Put the mirror built in 'staging' in place of .Mirror, then delete the previous one in the background."""
+    old_mirror = old_mirror_path()
+    if exchange_folders(staging, REAL_MIRROR_FOLDER):
+        staging.rename(old_mirror)
+    else:
+        # For a moment there's no .Mirror at all.
+        logger.debug("Folders can't be swapped atomically here, renaming them one after the other..")
+        REAL_MIRROR_FOLDER.rename(old_mirror)
+        staging.rename(REAL_MIRROR_FOLDER)
+    delete_old_mirrors()
+
+def delete_old_mirrors():
+    # Not a daemon thread, exiting waits for the deletion to finish.
+    for entry in os.scandir(MIRROR_FOLDER_PATH):
+        if entry.name.startswith(OLD_MIRROR_PREFIX) and entry.path not in deleting_mirrors:
+            deleting_mirrors.add(entry.path)
+            logger.debug(f"Deleting previous mirror '{entry.name}' in the background..")
+            threading.Thread(target=delete_folder, args=(entry.path,), name=f"delete {entry.name}").start()
+
+def update_mirror():
+    global file_strategies, mirror_folder_path, root_folder_path, root_prefix_length, walked_dirs, walked_files, walk_stat_calls, pruned_dirs, manifest, reuse_folder_path, detect_moves, deduplicating
+    if not REAL_MIRROR_FOLDER.exists():
+        logger.info(f"Existing .Mirror folder not found in '{MIRROR_FOLDER_PATH}', creating one now!")
+        REAL_MIRROR_FOLDER.mkdir()
+
+    logger.info(f"Using folder '{ROOT_FOLDER_PATH}' as root folder")
+    logger.info(f"Using folder '{REAL_MIRROR_FOLDER}' as mirror folder")
+    logger.debug("Copying with " + ", ".join(f"{workers} worker(s) for {lane} files" for lane, workers in zip(LANE_NAMES, LANE_WORKERS)))
+
+    with timed_phase("manifest"):
+        loaded_manifest = current_manifest() if INCREMENTAL else None
+    # Without a manifest the mirror folder has to be listed to find out what's stale.
+    manifest_loaded = loaded_manifest is not None
+    manifest = loaded_manifest or Manifest()
+    previous_names = set(manifest.names[row] for row in manifest.rows.values())
+    logger.debug(f"Loaded manifest with {len(manifest)} file(s)")
+
+    staging = MIRROR_FOLDER_PATH / STAGING_FOLDER_NAME
+    if STAGED_BUILD:
+        if staging.exists():
+            logger.debug("Deleting the unfinished mirror left by an interrupted run..")
+            delete_folder(str(staging))
+        staging.mkdir()
+    elif not INCREMENTAL:
+        logger.info("Erasing previous mirror")
+        with timed_phase("erase"):
+            # Moving it aside is instant, its files are deleted in the background while the new mirror is copied.
+            REAL_MIRROR_FOLDER.rename(old_mirror_path())
+            REAL_MIRROR_FOLDER.mkdir()
+            delete_old_mirrors()
+
+    logger.info("Updating mirror")
+    mirror_folder_path = str(staging if STAGED_BUILD else REAL_MIRROR_FOLDER)
+    # A full rebuild recopies everything, staged or not.
+    reuse_folder_path = str(REAL_MIRROR_FOLDER) if STAGED_BUILD and INCREMENTAL else ""
+    root_folder_path = str(ROOT_FOLDER_PATH)
+    root_prefix_length = len(os.path.join(root_folder_path, ""))
+    if COPY_STRATEGY == "auto":
+        # Probe once up front, then try the remaining (slower) strategies per file only if the first one fails.
+        probed_strategy = probe_copy_strategy()
+        file_strategies = COPY_STRATEGIES[COPY_STRATEGIES.index(probed_strategy):]
+        logger.info(f"Mirroring files using '{probed_strategy}'")
+    else:
+        file_strategies = [COPY_STRATEGY]
+    deduplicating = DEDUPLICATE and file_strategies[0] != "hardlink"
+    if DEDUPLICATE and not deduplicating:
+        logger.info("Not deduplicating, every mirrored file is a hardlink to its original already.")
+    content_holders.clear()
+    held_contents.clear()
+
+    folder_files.clear()
+    folder_snapshots.clear()
+    visited_folders.clear()
+    folder_ids.clear()
+    unlisted_folders.clear()
+    claimed_moves.clear()
+    moved_names.clear()
+    walked_dirs = 0
+    walked_files = 0
+    walk_stat_calls = 1
+    pruned_dirs = 0
+    # Against an empty manifest there's nothing a new file could have been moved from.
+    detect_moves = len(manifest) > 0
+    expected = None
+    if ESTIMATE_SAMPLES > 0:
+        with timed_phase("estimate"):
+            expected = estimate_files(ESTIMATE_SAMPLES)
+        logger.info(f"Guessing there are about {expected[0]:,} file(s) and {format_size(expected[1])} to mirror")
+    elif manifest_loaded:
+        # The previous run's files are the best guess at what's there now.
+        expected = len(manifest), manifest.total_size()
+    # Copies start while the walk is still going, "copy" is only the wait for the ones left after it.
+    with reporting_progress(expected), CopyLanes() as lanes:
+        with timed_phase("walk"):
+            root_stat = os.stat(root_folder_path)
+            enter_folder(root_folder_path, root_stat)
+            mirror_folder(root_folder_path, "", lanes, root_stat.st_mtime_ns)
+        with timed_phase("copy"):
+            report_all_copy_jobs(lanes)
+    mirrored_files = {relative for files in folder_files.values() for relative in files}
+    vanished = manifest.keys() - mirrored_files
+    kept_names = keep_unlisted(vanished)
+    logger.info(f"Walked {walked_dirs} folder(s) ({pruned_dirs} unchanged and not listed) and {walked_files} file(s) using {walk_stat_calls} stat call(s)")
+    count("walked_folders", walked_dirs)
+    count("unlisted_folders", pruned_dirs)
+    count("stat", walk_stat_calls)
+
+    copied_count, unchanged_count, failed_count = finish_copy_jobs()
+    # From now on the manifest knows the mirror, watched changes can be moves.
+    detect_moves = True
+
+    removed_count = 0
+    with timed_phase("cleanup"):
+        if STAGED_BUILD:
+            # Stale files simply weren't brought over, they go with the previous mirror.
+            if manifest_loaded:
+                mirrored_names = {name for files in folder_files.values() for name in files.values()} | kept_names
+                removed_count = len(previous_names - mirrored_names - moved_names)
+        elif INCREMENTAL:
+            mirrored_names = {name for files in folder_files.values() for name in files.values()} | kept_names
+            if manifest_loaded:
+                removed_count = remove_mirrored(previous_names - mirrored_names - moved_names, "its source no longer exists")
+                remove_moved((previous_names - mirrored_names) & moved_names)
+            else:
+                for fsobj in REAL_MIRROR_FOLDER.iterdir():
+                    if fsobj.name in mirrored_names or fsobj.name.startswith(MANIFEST_NAME):
+                        continue
+                    file_logger.debug(f"Deleting file '{fsobj.name}' because its source no longer exists..")
+                    if fsobj.is_dir() and not fsobj.is_symlink():
+                        import shutil
+                        shutil.rmtree(fsobj)
+                    else:
+                        fsobj.unlink()
+                    count("unlink")
+                    removed_count += 1
+                count("removed_files", removed_count)
+        forget_files(vanished)
+        save_manifest()
+    if STAGED_BUILD:
+        with timed_phase("swap"):
+            swap_in_staged_mirror(staging)
+        mirror_folder_path = str(REAL_MIRROR_FOLDER)
+        reuse_folder_path = ""
+
+    logger.info(f"Copied {copied_count} file(s), {unchanged_count} unchanged, moved {len(moved_names)}, removed {removed_count} stale file(s)")
+    if failed_count:
+        logger.warning(f"{failed_count} file(s) could not be copied, see the errors above.")
+
+    logger.info("Mirror updated! If something doesn't look right, double check for warnings above!")
+    logger.info("Still can't find your problem? Try running with '-v' or '--verbose'")
+    return copied_count, unchanged_count, failed_count, len(moved_names), removed_count
+
+def plan_update() -> tuple[list[str], list[str]]:
+    """What update_mirror() would change right now, without changing anything.
+
+    Returns the relative paths of the files it would copy and the mirror names it would remove. A moved file is in
+    both, moves are only spotted while updating. Nothing gets hashed, so with COMPARE_HASHES a file that was only
+    touched is listed as a copy.
+    """
+    global manifest, detect_moves, planned_copies, root_folder_path, root_prefix_length, mirror_folder_path
+    # Staying open (or a Mirror) keeps these for the next update, the walk below must leave them as they were.
+    kept = manifest, detect_moves, mirror_folder_path, dict(folder_files), dict(folder_snapshots), set(visited_folders), dict(folder_ids), set(unlisted_folders)
+    stored = current_manifest() if INCREMENTAL and REAL_MIRROR_FOLDER.exists() else None
+    manifest = stored or Manifest()
+    # Compared against the mirror as it is, not a staged one.
+    mirror_folder_path = str(REAL_MIRROR_FOLDER)
+    root_folder_path = str(ROOT_FOLDER_PATH)
+    root_prefix_length = len(os.path.join(root_folder_path, ""))
+    folder_files.clear()
+    folder_snapshots.clear()
+    visited_folders.clear()
+    folder_ids.clear()
+    unlisted_folders.clear()
+    # Files the manifest doesn't know are copies, moves are only looked for while updating.
+    detect_moves = False
+    planned_copies = []
+    try:
+        with timed_phase("plan"), CopyLanes() as lanes:
+            root_stat = os.stat(root_folder_path)
+            enter_folder(root_folder_path, root_stat)
+            mirror_folder(root_folder_path, "", lanes, root_stat.st_mtime_ns)
+            report_all_copy_jobs(lanes)
+        copies = planned_copies
+        mirrored_names = {name for files in folder_files.values() for name in files.values()}
+        if stored is not None:
+            previous_names = set(stored.names[row] for row in stored.rows.values())
+            mirrored_names |= {stored.get(relative)[0] for relative in unlisted_files(stored.keys())}
+        elif REAL_MIRROR_FOLDER.exists():
+            previous_names = {name for name in os.listdir(REAL_MIRROR_FOLDER) if not name.startswith(MANIFEST_NAME)}
+        else:
+            previous_names = set()
+    finally:
+        drop_copy_jobs()
+        planned_copies = None
+        manifest, detect_moves, mirror_folder_path, *walk_state = kept
+        for current, previous in zip((folder_files, folder_snapshots, visited_folders, folder_ids, unlisted_folders), walk_state):
+            current.clear()
+            current.update(previous)
+    return copies, sorted(previous_names - mirrored_names)
+
+def verify_file(name: str, size: int, expected: bytes) -> str | None:
+    """Hash the mirror file 'name', returning what's wrong with it or None if it matches 'expected'."""
+    try:
+        digest = file_digest(os.path.join(mirror_folder_path, name), size)
+    except OSError as e:
+        return e.strerror
+    return None if digest == expected else "its contents changed since it was copied"
+
+def verify_mirror() -> bool:
+    """Check every mirrored file with a stored hash, several at a time. Returns whether they all matched."""
+    global mirror_folder_path
+    with timed_phase("manifest"):
+        stored = load_manifest()
+    if stored is None:
+        logger.critical(f"No manifest found in '{REAL_MIRROR_FOLDER}', update the mirror with HASH_COPIES = true first.")
+        return False
+    mirror_folder_path = str(REAL_MIRROR_FOLDER)
+    # Biggest first: a single file can't be split between workers, so one started last would leave the rest idle.
+    hashed = sorted((entry for entry in stored.values() if entry[5] is not None), key=lambda entry: entry[1], reverse=True)
+    # With HASH_WORKERS every thread mostly waits on a hashing process, so there should be enough threads to keep them all busy.
+    workers = max(WORKERS, HASH_WORKERS)
+    logger.info(f"Verifying {len(hashed)} file(s) with {workers} worker(s)" + (f" and {HASH_WORKERS} hashing process(es)" if HASH_WORKERS > 0 else ""))
+    failed_count = 0
+    with timed_phase("verify"), ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, problem in zip(hashed, executor.map(lambda entry: verify_file(entry[0], entry[1], entry[5]), hashed)):
+            if problem is not None:
+                logger.error(f"Mirrored file '{entry[0]}' failed verification: {problem}")
+                failed_count += 1
+    count("verified_files", len(hashed) - failed_count)
+    count("failed_files", failed_count)
+    logger.info(f"Verified {len(hashed) - failed_count} file(s), {failed_count} failed, {len(stored) - len(hashed)} without a stored hash")
+    return failed_count == 0
+
+def abandon_update():
+    """Clean up after update_mirror() stopped halfway."""
+    global mirror_folder_path, reuse_folder_path, known_manifest
+    # Watched changes go to the real mirror, not to a half built staged one.
+    mirror_folder_path = str(REAL_MIRROR_FOLDER)
+    reuse_folder_path = ""
+    # Half updated, the manifest in memory might describe files that only made it into a staged mirror.
+    known_manifest = None
+    drop_copy_jobs()
+
+def try_update_mirror():
+    # Staying open shouldn't end because one run hit a folder that vanished or a full disk.
+    try:
+        update_mirror()
+    except OSError as e:
+        logger.error(f"Updating the mirror failed: {e}")
+        abandon_update()
+
+def next_resync() -> float | None:
+    if RESYNC_INTERVAL <= 0:
+        return None
+    from random import uniform
+    return time.monotonic() + RESYNC_INTERVAL + uniform(0, RESYNC_JITTER)
+
+def stay_resident():
+    """Stay open without using any CPU until stopped with SIGTERM or Ctrl+C.
+
+    Sleeps until either a watched change, the next RESYNC_INTERVAL or a signal comes in.
+    Signals are turned into bytes on a socket (signal.set_wakeup_fd) so one select() waits on everything.
+    """
+    global watcher
+    import socket
+    import selectors
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    wakeup_reader.setblocking(False)
+    wakeup_writer.setblocking(False)
+    signal.set_wakeup_fd(wakeup_writer.fileno())
+    for signum in STOP_SIGNALS + ([signal.SIGHUP] if hasattr(signal, "SIGHUP") else []):
+        # The handler has nothing to do, the wakeup socket already received the signal number.
+        signal.signal(signum, lambda *_: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(wakeup_reader, selectors.EVENT_READ, "signal")
+    if watcher is not None:
+        selector.register(watcher.fd, selectors.EVENT_READ, "watch")
+    resync_at = next_resync()
+    if WATCH:
+        logger.info(f"Watching '{ROOT_FOLDER_PATH}' for changes, press Ctrl+C to stop.")
+    else:
+        logger.info("Staying open, press Ctrl+C to stop.")
+    while True:
+        timeout = None if resync_at is None else max(0, resync_at - time.monotonic())
+        ready = selector.select(timeout)
+        if not ready:
+            logger.info("Updating the whole mirror again")
+            try_update_mirror()
+            resync_at = next_resync()
+            continue
+        for key, _events in ready:
+            if key.data == "watch":
+                mirror_watched_changes()
+                continue
+            received = wakeup_reader.recv(64)
+            if any(signum in received for signum in STOP_SIGNALS):
+                logger.info("Stopping.")
+                # Watched changes only updated the manifest in memory.
+                if watcher is not None:
+                    save_manifest()
+                return
+            logger.info("Reloading mirror_config.toml")
+            try:
+                config = read_config()
+                reloaded = apply_config(config)
+            except (OSError, ValueError) as e:  # tomllib.TOMLDecodeError is a ValueError
+                logger.critical(f"Could not read mirror_config.toml: {e}")
+                reloaded = False
+            if not reloaded:
+                logger.error("Keeping the previous configuration.")
+                continue
+            cache_config(config)
+            if watcher is not None:
+                # The root folder might have changed, start over with fresh watches.
+                selector.unregister(watcher.fd)
+                watcher.close()
+                watcher = Inotify()
+                selector.register(watcher.fd, selectors.EVENT_READ, "watch")
+            try_update_mirror()
+            resync_at = next_resync()
+
+class Mirror:
+    """Keeps a mirror up to date from inside a long running program, without starting this script for every update.
+
+    'config' takes the same settings as mirror_config.toml, which is read (never created) when it's left out. What's known about the
+    mirror (the manifest, every folder's files and mtime) stays in memory between calls instead of being read again.
+    All of that lives in this module though, so only one Mirror is in use at a time. Switching to another one reads
+    its manifest from its mirror folder.
+
+    sync(), sync_paths() and plan() raise OSError when the mirror can't be updated (a vanished root folder, a full disk),
+    files that fail to copy are only logged and counted.
+    """
+
+    active: ClassVar["Mirror | None"] = None
+
+    def __init__(self, config: dict | None = None):
+        self.config = read_config(create_default=False) if config is None else dict(config)
+        # Whether the walk state in this module is this mirror's, so sync_paths() can build on it.
+        self.synced = False
+        # Whether sync_paths() changed the manifest in memory since it was last saved.
+        self.unsaved = False
+        self.activate()
+
+    def activate(self):
+        """Switch this module's settings over to this mirror's, raising ValueError if they aren't valid."""
+        if Mirror.active is self:
+            return
+        if Mirror.active is not None:
+            Mirror.active.close()
+            Mirror.active.synced = False
+        if not apply_config(self.config):
+            Mirror.active = None
+            raise ValueError("Invalid mirror configuration, see the log for what's wrong with it.")
+        Mirror.active = self
+
+    def plan(self) -> tuple[list[str], list[str]]:
+        """The relative paths of the files sync() would copy and the mirror names it would remove, see plan_update()."""
+        self.activate()
+        return plan_update()
+
+    def sync(self) -> tuple[int, int, int, int, int]:
+        """Update the whole mirror, returning how many files were copied, unchanged, failed, moved and removed."""
+        self.activate()
+        self.synced = False
+        try:
+            result = update_mirror()
+        except BaseException:
+            abandon_update()
+            raise
+        self.synced = True
+        self.unsaved = False
+        return result
+
+    def sync_paths(self, paths) -> tuple[int, int, int, int, int]:
+        """Update only what's at 'paths' (below the root folder, absolute or relative to it) after they were created, changed or deleted.
+
+        Like '--watch', only the folders holding them are listed again. The first call is a sync() of the whole mirror.
+        Returns the same counts as sync(), the manifest is saved by the next sync() or close().
+        """
+        self.activate()
+        if not self.synced:
+            return self.sync()
+        result = apply_changes(path_events(paths))
+        self.unsaved = True
+        return result
+
+    def close(self):
+        """Save what sync_paths() changed. The Mirror can still be used afterwards."""
+        if Mirror.active is self and self.unsaved:
+            save_manifest()
+            self.unsaved = False
+
+    def __enter__(self) -> "Mirror":
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+def main():
+    global args, WATCH, VERBOSE, watcher
+    args = parse_args()
+    WATCH = args.watch
+    VERBOSE = args.verbose
+    logger.setLevel(logging.INFO if not VERBOSE else logging.DEBUG)
+    file_logger.setLevel(logging.DEBUG if VERBOSE > 1 else logging.INFO)
+    log_in_background()
+    if WATCH and not sys.platform.startswith("linux"):
+        logger.critical("'--watch' is only supported on Linux.")
+        exit()
+    if args.stats:
+        atexit.register(write_stats)
+    with timed_phase("config"):
+        config = read_config()
+        config_applied = apply_config(config)
+    if not config_applied:
+        exit()
+    cache_config(config)
+    if args.verify:
+        sys.exit(0 if verify_mirror() else 1)
+    if WATCH:
+        watcher = Inotify()
+    update_mirror()
+
+    if WATCH or CLOSE_DELAY == -1:
+        stay_resident()
+    for i in range(CLOSE_DELAY):
+        logger.info(CLOSE_MESSAGE.format(CLOSE_DELAY - i) + "." * i)
+        time.sleep(CLOSE_DELAY / CLOSE_DELAY)
 
-        relative_fsobj = fsobj.relative_to(ROOT_FOLDER_PATH)
-        file_name = f"{relative_fsobj.as_posix().replace("/", PATH_SEPARATOR)}" \
-                    if PRESERVE_FILE_NAMES else \
-                    f"{relative_fsobj.parent.as_posix().replace("/", PATH_SEPARATOR)}-{i}{relative_fsobj.suffix}"
-        
-        logger.debug(f"Copying file '{fsobj.name}' to '{REAL_MIRROR_FOLDER / file_name}' ..")
-        shutil.copyfile(str(fsobj), REAL_MIRROR_FOLDER / file_name)
-mirror_folder(ROOT_FOLDER_PATH)
-
-logger.info("Mirror updated! If something doesn't look right, double check for warnings above!")
-logger.info("Still can't find your problem? Try running with '-v' or '--verbose'")
-
-while CLOSE_DELAY == -1:
-    pass
-for i in range(CLOSE_DELAY):
-    logger.info(CLOSE_MESSAGE.format(CLOSE_DELAY - i) + "." * i)
-    time.sleep(CLOSE_DELAY / CLOSE_DELAY)
+# The hashing processes import this file too, they must not start mirroring.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import io
+import os
+import re
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import mirror
+
+
+def fake_entry(size: int = 0, age: float = 0) -> SimpleNamespace:
+    entry_stat = os.stat_result((0o100644, 0, 0, 1, 0, 0, size, 0, int(time.time() - age), 0))
+    return SimpleNamespace(stat=lambda follow_symlinks=True: entry_stat)
+
+
+class GlobToRegexTest(unittest.TestCase):
+    def assert_matches(self, glob: str, matching: list[str], not_matching: list[str]):
+        regex = re.compile(mirror.glob_to_regex(glob) + r"\Z", re.DOTALL)
+        for path in matching:
+            self.assertTrue(regex.match(path), f"'{glob}' should match '{path}'")
+        for path in not_matching:
+            self.assertFalse(regex.match(path), f"'{glob}' should not match '{path}'")
+
+    def test_star_stays_in_one_folder(self):
+        self.assert_matches("*.txt", ["a.txt", ".txt"], ["a/b.txt", "a.txt.bak"])
+
+    def test_question_mark(self):
+        self.assert_matches("file?.log", ["file1.log"], ["file.log", "file12.log", "file/.log"])
+
+    def test_double_star(self):
+        self.assert_matches("**/cache", ["cache", "a/cache", "a/b/cache"], ["cache/a", "acache"])
+        self.assert_matches("build/**", ["build/a", "build/a/b"], ["build", "builder/a"])
+        self.assert_matches("a/**/z", ["a/z", "a/b/z", "a/b/c/z"], ["az", "b/z"])
+
+    def test_sets(self):
+        self.assert_matches("[abc].py", ["a.py", "c.py"], ["d.py", "ab.py"])
+        self.assert_matches("[!abc].py", ["d.py"], ["a.py"])
+        self.assert_matches("[]].py", ["].py"], ["a.py"])
+        self.assert_matches("[unclosed", ["[unclosed"], ["u"])
+
+    def test_alternatives(self):
+        self.assert_matches("*.{jpg,png}", ["a.jpg", "b.png"], ["c.gif", "a.jpg.png/x"])
+        self.assert_matches("{src,lib}/**", ["src/a", "lib/b/c"], ["doc/a"])
+
+    def test_special_characters_are_literal(self):
+        self.assert_matches("a+b(1).txt", ["a+b(1).txt"], ["aab1.txt"])
+
+
+class RulesTest(unittest.TestCase):
+    def test_names_match_in_any_folder(self):
+        rules = mirror.Rules(["*.ini", ".*"])
+        self.assertTrue(rules.matches("x.ini", "x.ini", False, None))
+        self.assertTrue(rules.matches(os.path.join("a", "b", "x.ini"), "x.ini", False, None))
+        self.assertTrue(rules.matches(".git", ".git", True, None))
+        self.assertFalse(rules.matches("x.txt", "x.txt", False, None))
+
+    def test_paths_are_tied_to_the_root(self):
+        rules = mirror.Rules(["/top.txt", "docs/*.md"])
+        self.assertTrue(rules.matches("top.txt", "top.txt", False, None))
+        self.assertFalse(rules.matches(os.path.join("a", "top.txt"), "top.txt", False, None))
+        self.assertTrue(rules.matches(os.path.join("docs", "a.md"), "a.md", False, None))
+        self.assertFalse(rules.matches(os.path.join("a", "docs", "a.md"), "a.md", False, None))
+
+    def test_trailing_slash_only_matches_folders(self):
+        rules = mirror.Rules(["build/"])
+        self.assertTrue(rules.matches("build", "build", True, None))
+        self.assertFalse(rules.matches("build", "build", False, None))
+
+    def test_trailing_double_star_matches_the_folder_itself(self):
+        rules = mirror.Rules(["build/**", "**/node_modules/**"])
+        self.assertTrue(rules.matches("build", "build", True, None))
+        self.assertTrue(rules.matches(os.path.join("build", "a.o"), "a.o", False, None))
+        self.assertTrue(rules.matches(os.path.join("a", "node_modules"), "node_modules", True, None))
+        self.assertTrue(rules.matches("node_modules", "node_modules", True, None))
+        # Only what's below it, a file of that name is something else.
+        self.assertFalse(rules.matches("build", "build", False, None))
+        self.assertFalse(rules.matches(os.path.join("a", "build"), "build", True, None))
+
+    def test_no_patterns_match_nothing(self):
+        rules = mirror.Rules([])
+        self.assertFalse(rules.matches("a", "a", True, None))
+        self.assertFalse(rules.matches("a", "a", False, None))
+
+    def test_predicates(self):
+        rules = mirror.Rules(["size > 1 MB", "age>2d"])
+        with mock.patch.object(mirror, "SYMLINKS", "follow", create=True):
+            self.assertTrue(rules.matches("big", "big", False, fake_entry(size=2 * 1024 ** 2)))
+            self.assertTrue(rules.matches("old", "old", False, fake_entry(age=3 * 86400)))
+            self.assertFalse(rules.matches("small", "small", False, fake_entry(size=1024, age=60)))
+        # Folders have no size or age worth excluding them by.
+        self.assertFalse(rules.matches("folder", "folder", True, None))
+
+    def test_unknown_unit(self):
+        with self.assertRaises(ValueError):
+            mirror.Rules(["size > 1 parsec"])
+
+
+class ManifestTest(unittest.TestCase):
+    KEY = ("/root", "#,", True, (), "follow", (), (), "blake2b")
+
+    def example(self) -> mirror.Manifest:
+        manifest = mirror.Manifest()
+        manifest["top.txt"] = ("top.txt", 3, 1_700_000_000_123_456_789, 2049, 11, None)
+        manifest[os.path.join("a", "one.txt")] = ("a#,one.txt", 10, 5, 2049, 12, b"\x01" * 32)
+        manifest[os.path.join("a", "b", "two.bin")] = ("a#,b#,two.bin", 2 ** 40, 6, 2 ** 63, 2 ** 64 - 1, b"\x02" * 32)
+        # Undecodable names come back as they were.
+        manifest["caf\udce9.txt"] = ("caf\udce9.txt", 0, 0, 1, 1, None)
+        return manifest
+
+    def layout(self) -> list:
+        return [
+            ("", 100, ["top.txt", "caf\udce9.txt"], ["a"]),
+            ("a", 200, [os.path.join("a", "one.txt")], ["b"]),
+            (os.path.join("a", "b"), None, [os.path.join("a", "b", "two.bin")], []),
+        ]
+
+    def round_trip(self, manifest: mirror.Manifest, layout: list, key: tuple = KEY) -> mirror.Manifest | None:
+        f = io.BytesIO()
+        manifest.dump(f, self.KEY, layout)
+        f.seek(0)
+        return mirror.Manifest.load(f, key)
+
+    def assert_same(self, loaded: mirror.Manifest, expected: mirror.Manifest):
+        self.assertEqual(dict(loaded.items()), dict(expected.items()))
+        self.assertEqual(loaded.folders, expected.folders)
+
+    def test_round_trip(self):
+        manifest = self.example()
+        entries = dict(manifest.items())
+        loaded = self.round_trip(manifest, self.layout())
+        self.assertEqual(dict(loaded.items()), entries)
+        # dump() leaves the manifest exactly as load() returns it.
+        self.assert_same(loaded, manifest)
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(loaded.total_size(), sum(entry[1] for entry in entries.values()))
+
+    def test_folder_snapshots(self):
+        loaded = self.round_trip(self.example(), self.layout())
+        self.assertEqual(loaded.folder_snapshot("", 100), ({"top.txt": "top.txt", "caf\udce9.txt": "caf\udce9.txt"}, ("a",)))
+        self.assertEqual(loaded.folder_snapshot("a", 200), ({os.path.join("a", "one.txt"): "a#,one.txt"}, ("b",)))
+        self.assertIsNone(loaded.folder_snapshot("a", 201))
+        # Too recent to trust when it was saved, so never taken as unchanged.
+        self.assertIsNone(loaded.folder_snapshot(os.path.join("a", "b"), 0))
+        self.assertIsNone(loaded.folder_snapshot("missing", 100))
+
+    def test_failed_file_drops_the_folder_snapshot(self):
+        manifest = self.example()
+        manifest.pop(os.path.join("a", "one.txt"))
+        loaded = self.round_trip(manifest, self.layout())
+        self.assertNotIn(os.path.join("a", "one.txt"), loaded)
+        self.assertIsNone(loaded.folder_snapshot("a", 200))
+        self.assertEqual(len(loaded), 3)
+
+    def test_files_outside_the_layout_are_kept(self):
+        manifest = self.example()
+        loaded = self.round_trip(manifest, self.layout()[:1])
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(loaded.get(os.path.join("a", "b", "two.bin"))[0], "a#,b#,two.bin")
+
+    def test_round_trip_twice(self):
+        manifest = self.example()
+        loaded = self.round_trip(manifest, self.layout())
+        loaded["new.txt"] = ("new.txt", 1, 2, 3, 4, None)
+        layout = self.layout()
+        layout[0][2].append("new.txt")
+        again = self.round_trip(loaded, layout)
+        self.assert_same(again, loaded)
+        self.assertEqual(again.folder_snapshot("", 100)[0]["new.txt"], "new.txt")
+
+    def test_empty(self):
+        loaded = self.round_trip(mirror.Manifest(), [])
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(loaded.folders, {})
+
+    def test_other_key_or_version(self):
+        self.assertIsNone(self.round_trip(self.example(), self.layout(), key=self.KEY[:-1] + ("sha256",)))
+        with mock.patch.object(mirror.Manifest, "VERSION", mirror.Manifest.VERSION + 1):
+            f = io.BytesIO()
+            self.example().dump(f, self.KEY, self.layout())
+        f.seek(0)
+        self.assertIsNone(mirror.Manifest.load(f, self.KEY))
+
+    def test_files_like(self):
+        manifest = self.round_trip(self.example(), self.layout())
+        one = os.path.join("a", "one.txt")
+        self.assertEqual(manifest.files_like((2049, 12)), {one})
+        self.assertEqual(manifest.files_like((10,)), {one})
+        self.assertEqual(manifest.files_like((10, b"\x01" * 32)), {one})
+        self.assertEqual(manifest.files_like((3,)), set())
+        manifest["moved.txt"] = ("moved.txt", 10, 5, 2049, 13, b"\x01" * 32)
+        self.assertEqual(manifest.files_like((10, b"\x01" * 32)), {one, "moved.txt"})
+
+
+if __name__ == "__main__":
+    unittest.main()